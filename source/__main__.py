@@ -3,13 +3,19 @@ __title__ = 'PixelSlime'
 __licence__ = 'MIT'
 __version__ = '3.11'
 
+import os
 import sys
 
 import pygame
 
-from constants import FPS, SCREEN_SIZE, UserEvents
+from animation import clock
+from constants import FPS, SCREEN_SIZE, PROFILE_ENV, DB_GUARD_ENV, Messages, Media
+from diagnostics import frame_timer, latency, allocations, profile_capture, query_stats, surface_registry
 from menu import Menu
-from utils import catch_events, DataBase
+from precompute import level_artefacts, get_layout
+from templates import ProgressScreen, ProfilerOverlay, hit_index
+from utils import (dispatcher, bus, DataBase, MediaPreloader, get_media_manifest, get_startup_manifest, media_packs,
+                   scheduler)
 
 
 class Main:
@@ -20,54 +26,174 @@ class Main:
 
         self._session = 0
 
-        self._windows_stack = [Menu()]
+        self._windows_stack = []  # Menu is opened after warm up
         self._freezers = []
+        self._media_task = None  # loads media which is not shown by the menu, see _warm_up()
+
+        for topic, handler in (
+                (Messages.SET_CWW, self._set_cww),
+                (Messages.CLOSE_CWW, self._close_cww),
+                (Messages.FREEZE_CWW, self._freezers.append),
+                (Messages.UNFREEZE_CWW, self._freezers.remove),
+                (Messages.START_SESSION, self._start_session),
+                (Messages.SAVE_LEVEL, self._save_level),
+                (Messages.DELETE_LEVEL, self._delete_level),
+                (Messages.RUN_WITH_UID, self._run_with_uid)
+        ):
+            bus.subscribe(topic, handler)
+        # terminates executing if pygame.quit() in run() didn't do it
+        dispatcher.subscribe(pygame.QUIT, lambda _event: sys.exit())
+        dispatcher.subscribe(pygame.KEYDOWN, self._toggle_diagnostics)
+
+        self._profiler_overlay = ProfilerOverlay(0, 0, 360, 340)
+        if frames := os.environ.get(PROFILE_ENV):  # the first frames after warm up are profiled
+            if not frames.strip().isdigit() or int(frames) < 1:
+                raise ValueError(f'{PROFILE_ENV} must be a positive number of frames, got {frames!r}')
+            profile_capture.request(int(frames))
+        if (guard := os.environ.get(DB_GUARD_ENV)) not in (None, *query_stats.GUARD_MODES):
+            raise ValueError(f'{DB_GUARD_ENV} must be one of {", ".join(filter(None, query_stats.GUARD_MODES))}')
+        query_stats.guard = guard
+
+    def _warm_up(self):
+        # media is decoded on worker threads meanwhile main thread converts decoded images (within the frame budget)
+        # and shows progress. Only media of the menu is waited for, the rest is converted by a task of the scheduler
+        # within frames of the menu (see _end_frame()), so no frame blocks on loading media afterwards, unless another
+        # window is opened before that. Packs are loaded on demand (see utils.MediaPacks), only the first one is
+        # requested in advance, since it is opened by the editor
+        preloader = MediaPreloader(get_startup_manifest())
+        progress_screen = ProgressScreen(0, 0, *SCREEN_SIZE)
+
+        while not preloader.done:
+            clock.tick()
+            if any(event.type == pygame.QUIT for event in pygame.event.get()):
+                sys.exit()
+
+            preloader.convert(budget=1 / FPS / 2)
+            progress_screen.progress = preloader.progress
+            progress_screen.handle()
+            self._screen.blit(progress_screen, progress_screen.get_rect())
 
-    def _eventloop(self):
-        for event in catch_events():  # gets a new queue of events
-            if event.type == UserEvents.SET_CWW and self._windows_stack[-1] != event.window:
-                self._windows_stack.append(event.window)
-            if event.type == UserEvents.CLOSE_CWW:
-                self._windows_stack.pop()
-            if event.type == UserEvents.FREEZE_CWW:
-                self._freezers.append(event.freezer)
-            if event.type == UserEvents.UNFREEZE_CWW:
-                self._freezers.remove(event.freezer)
-            if event.type == UserEvents.START_SESSION:
-                self._session = event.uid
-            if event.type == UserEvents.SAVE_LEVEL:
-                DataBase().create_level(event.name, event.fdata, self._session, event.pack)
-            if event.type == UserEvents.DELETE_LEVEL:
-                DataBase().delete_level(event.level_id)
-            if event.type == UserEvents.RUN_WITH_UID:
-                event.runner(self._session)
-            if event.type == pygame.QUIT or not self._windows_stack:
-                sys.exit()  # terminates executing if pygame.quit() in run() didn't do it
+            pygame.display.flip()
+            self._clock.tick(FPS)
+
+        self._media_task = scheduler.spawn(MediaPreloader(get_media_manifest()).run())
+        media_packs.load(Media.PACKS[0])
+        self._windows_stack.append(Menu())
+
+    def _set_cww(self, window):
+        if self._windows_stack[-1] != window:
+            self._windows_stack.append(window)
+
+    def _close_cww(self):
+        self._windows_stack.pop().close()
+
+    def _start_session(self, uid):
+        self._session = uid
+
+    def _save_level(self, name, fdata, pack, on_error):
+        level_id = DataBase().create_level(name, fdata, self._session, pack, on_error=on_error)
+        # so the first opening of the level uses the artefact
+        level_artefacts.request(level_id, get_layout(fdata), pack)
+
+    @staticmethod
+    def _delete_level(level_id, on_error):
+        DataBase().delete_level(level_id, on_error=on_error)
+
+    def _run_with_uid(self, runner):
+        runner(self._session)
+
+    @staticmethod
+    def _toggle_diagnostics(event):
+        if event.key == pygame.K_F3:
+            frame_timer.toggle()
+        elif event.key == pygame.K_F4:  # the report of allocations is written once tracking is toggled off
+            allocations.toggle()
+            if not allocations.enabled:
+                print(allocations.format_report(), file=sys.stderr)
+                allocations.export()
+        elif event.key == pygame.K_F5:  # the next frames are profiled, see _mainloop()
+            profile_capture.request()
+        elif event.key == pygame.K_F6:
+            print(query_stats.format_report(), file=sys.stderr)
+            query_stats.export()
+        elif event.key == pygame.K_F7:
+            print(surface_registry.format_report(), file=sys.stderr)
+            surface_registry.export()
+
+    def _sample_input(self):
+        clock.tick()  # time of animations is the same within a frame
+        hit_index.update()  # as well as position of the cursor
+        dispatcher.update()  # gets a new queue of events
+        dispatcher.dispatch()
+        latency.input_sampled(bool(dispatcher.get(pygame.KEYDOWN, pygame.MOUSEBUTTONDOWN)))
+
+    def _simulate(self):
+        # windows draw themselves on their own surfaces meanwhile, since handle() does both
+        if not self._freezers:  # if at least one freezer is active, cww is not handled
+            self._windows_stack[-1].handle()
+        frame_timer.mark('window')
+        for freezer in self._freezers:
+            freezer.handle()
+        frame_timer.mark('freezers')
+
+    def _render(self):
+        current_working_window = self._windows_stack[-1]
+        self._screen.blit(current_working_window, current_working_window.get_rect())
+        for freezer in self._freezers:
+            self._screen.blit(freezer, freezer.get_rect())
+
+        if frame_timer.enabled:  # toggled with F3
+            self._profiler_overlay.handle()
+            self._screen.blit(self._profiler_overlay, self._profiler_overlay.get_rect())
+
+    def _end_frame(self):
+        # messages are delivered after the windows have been handled, since the windows stack must not change within
+        # a frame (e.g. a window opening a freezer is handled at least once before Messages.FREEZE_CWW is delivered)
+        bus.deliver()
+        if not self._windows_stack:
+            sys.exit()
+        # failed writes of DataBase are reported from the main thread, since callbacks usually touch surfaces
+        DataBase.dispatch_write_errors()
+        # deferred work (continuations of jobs, loading media and packs, building levels) within the frame budget
+        scheduler.update()
+        media_packs.update()  # idle packs are unloaded
+        surface_registry.update()
+
+    def _run_frame(self):
+        # input is sampled right before the simulation, so it is handled in the same frame, not in the next one
+        frame_timer.begin()
+        allocations.next_frame()
+        query_stats.window = self._get_window_name()
+        self._sample_input()
+        frame_timer.mark('input')
+        self._simulate()
+        self._render()
+        frame_timer.mark('render')
+        pygame.display.flip()
+        latency.presented()
+        frame_timer.mark('present')
+        self._end_frame()
+        frame_timer.mark('end')
+        self._clock.tick(FPS)
+        frame_timer.mark('idle')
+
+    def _get_window_name(self):
+        return type(self._windows_stack[-1]).__name__
 
     def _mainloop(self):
         while True:
-            current_working_window = self._windows_stack[-1]
-
-            # if at least one freezer is active, cww is not handled
-            if not self._freezers:
-                current_working_window.handle()
-            self._screen.blit(current_working_window, current_working_window.get_rect())
-
-            for freezer in self._freezers:
-                freezer.handle()
-                self._screen.blit(freezer, freezer.get_rect())
-
-            # eventloop should be called exactly after drawing cww, because freezer might be called immediately,
-            # and we need to handle cww at least once before catching UserEvents.FREEZE_CWW event
-            self._eventloop()
-
-            pygame.display.flip()
-            self._clock.tick(FPS)
+            if profile_capture.requested:
+                profile_capture.capture(self._run_frame, self._get_window_name)
+            else:
+                self._run_frame()
 
     def run(self):
         try:
+            self._warm_up()
             self._mainloop()
         finally:
+            DataBase.flush()  # pending writes must reach the disk before exit
+            level_artefacts.close()
             pygame.quit()  # clear pygame stuff; make sure every running file will be closed correctly
 
 
@@ -2,13 +2,20 @@ __all__ = (
     'AuthTabs',
 )
 
+from concurrent.futures import ThreadPoolExecutor
+
 import pygame
 
-from constants import UserEvents
-from utils import post_event, DataBase
+from constants import Messages
+from utils import bus, DataBase
 from templates import BaseSurface, Button, Freezer, StyledForm
 
 
+# bcrypt hashes take a noticeable time (see constants.BCRYPT_ROUNDS), so they are never computed on the main thread.
+# bcrypt releases the GIL while hashing, one worker is enough for the only form submitted at a time
+_auth_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='auth')
+
+
 class _BaseAuth(StyledForm):
 
     def __init__(self, x, y, w, h, parent=None):
@@ -17,7 +24,17 @@ class _BaseAuth(StyledForm):
         self.add_field(placeholder='Логин')
         self.add_field(placeholder='Пароль', secret=True)
 
+        self._pending = None  # future of the check running on the worker
+        self._uid = None  # of the user, it is known once the check succeeds
+
+    @property
+    def pending(self):
+        return self._pending is not None
+
     def validate(self):
+        if self.pending:  # submit is ignored until the running check completes
+            return False
+
         for fld in self.fields:
             fld.errors.clear()
 
@@ -31,9 +48,48 @@ class _BaseAuth(StyledForm):
 
         return False
 
+    def check(self, login, password):
+        # runs on the worker, so only DataBase (a new connection for the thread) is available here.
+        # returns list of (field index, error) and uid of the user (None if there are errors), so the session is
+        # started without querying the database on the main thread
+        return [], None
+
+    def start_check(self):
+        self._pending = _auth_executor.submit(self.check, *self.as_tuple())
+
+    def _apply_check(self):
+        if not self.pending or not self._pending.done():
+            return
+
+        try:
+            errors, self._uid = self._pending.result()
+        except Exception:
+            errors = [(1, 'Не удалось выполнить проверку')]
+        self._pending = None
+
+        for idx, err in errors:
+            self.fields[idx].errors.append(err)
+        if not errors:
+            self.on_success()
+
+    def draw(self):
+        super().draw()
+
+        if self.pending:
+            rect = self.submit_button.get_rect()
+            overlay = pygame.Surface(rect.size, pygame.SRCALPHA)
+            pygame.draw.rect(overlay, (54, 53, 53, 200), overlay.get_rect(), border_radius=15)
+            text = self._font.render('Проверка...', True, (209, 203, 203))
+            overlay.blit(text, text.get_rect(center=overlay.get_rect().center))
+            self.blit(overlay, rect)
+
+    def eventloop(self):
+        self._apply_check()
+        super().eventloop()
+
     def on_success(self):
         super().on_success()
-        self.parent.on_form_success()
+        self.parent.on_form_success(self._uid)
 
 
 class _RegistrationForm(_BaseAuth):
@@ -51,12 +107,16 @@ class _RegistrationForm(_BaseAuth):
             self.fields[1].errors.append('Пароль слишком короткий')
             return False
 
+        self.start_check()
+        return False  # on_success() is called on check completion
+
+    def check(self, login, password):
+        db = DataBase()
         try:
-            DataBase().create_user(*self.as_tuple())
-            return True
+            db.create_user(login, password)
         except OverflowError:
-            self.fields[0].errors.append('Это имя занято')
-            return False
+            return [(0, 'Это имя занято')], None
+        return [], db.get_uid(login)
 
 
 class _AuthenticationForm(_BaseAuth):
@@ -66,20 +126,20 @@ class _AuthenticationForm(_BaseAuth):
         self.title = 'Авторизация'
 
     def validate(self):
-        v = super().validate()
-
-        if (uid := DataBase().get_uid(self.as_tuple()[0])) is None and self.as_tuple()[0]:
-            self.fields[0].errors.append('Пользователь с таким именем не найден')
+        if not super().validate():
             return False
 
-        if not v:
-            return False
+        self.start_check()
+        return False  # on_success() is called on check completion
 
-        if not DataBase().is_correct_password(uid, self.as_tuple()[1]):
-            self.fields[1].errors.append('Неверный пароль')
-            return False
+    def check(self, login, password):
+        db = DataBase()
+        if (uid := db.get_uid(login)) is None:
+            return [(0, 'Пользователь с таким именем не найден')], None
+        if not db.is_correct_password(uid, password):
+            return [(1, 'Неверный пароль')], None
 
-        return True
+        return [], uid
 
 
 class AuthTabs(BaseSurface, Freezer):
@@ -96,6 +156,19 @@ class AuthTabs(BaseSurface, Freezer):
         self._current_tab = self._tabs[0]
         self._switch_tab_button_text = self._switch_tab_button_texts[0]
 
+        # buttons listen to presses since the next frame they are handled in, so they are not created on every draw
+        font = pygame.font.SysFont('arial', self._switch_tab_button_text_font_size)
+        self._switch_tab_buttons = {}  # text: button
+        for text in self._switch_tab_button_texts:
+            hovered_text = font.render(text, True, (197, 197, 197))
+            not_hovered_text = font.render(text, True, (172, 172, 172))
+            btn_switch = Button(w // 2 - not_hovered_text.get_width() // 2, rect[3], *not_hovered_text.get_size(),
+                                parent=self)
+            btn_switch.set_hovered_view(hovered_text)
+            btn_switch.set_not_hovered_view(not_hovered_text)
+            btn_switch.bind_press(self._switch_tab)
+            self._switch_tab_buttons[text] = btn_switch
+
     @property
     def current_tab(self):
         return self._current_tab
@@ -112,22 +185,14 @@ class AuthTabs(BaseSurface, Freezer):
     def draw(self):
         self.fill((255, 255, 255, 0))
 
-        font = pygame.font.SysFont('arial', self._switch_tab_button_text_font_size)
-        hovered_text = font.render(self._switch_tab_button_text, True, (197, 197, 197))
-        not_hovered_text = font.render(self._switch_tab_button_text, True, (172, 172, 172))
-
-        btn_switch = Button(self.get_rect().w // 2 - not_hovered_text.get_width() // 2, self._current_tab.get_rect().h,
-                            *not_hovered_text.get_size(), parent=self)
-        btn_switch.set_hovered_view(hovered_text)
-        btn_switch.set_not_hovered_view(not_hovered_text)
-        btn_switch.bind_press(self._switch_tab)
+        btn_switch = self._switch_tab_buttons[self._switch_tab_button_text]
 
         self._current_tab.handle()
         self.blit(self._current_tab)
         btn_switch.handle()
         self.blit(btn_switch)
 
-    def on_form_success(self):
+    def on_form_success(self, uid):
         self.__del__()
         self.unfreeze()
-        post_event(UserEvents.START_SESSION, uid=DataBase().get_uid(self._current_tab.as_tuple()[0]))
+        bus.post(Messages.START_SESSION, uid)
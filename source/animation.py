@@ -0,0 +1,113 @@
+__all__ = (
+    'Animation',
+    'FrameStrip',
+    'clock'
+)
+
+import bisect
+import itertools
+
+import pygame
+
+from manifest import MediaManifest
+from utils import load_frames, media_cache
+
+
+class _Clock:
+    # Shared time of all animations. It is ticked once per frame (see Main), so every animation drawn within a frame
+    # uses the same time, and speed of animations does not depend on the frame rate
+
+    def __init__(self):
+        self._now = pygame.time.get_ticks() / 1000
+
+    @property
+    def now(self):
+        return self._now
+
+    def tick(self):
+        self._now = pygame.time.get_ticks() / 1000
+
+
+clock = _Clock()
+
+
+class FrameStrip(pygame.Surface):
+    # Frames of an animation packed into one surface (from left to right). Frames are subsurfaces of the strip, so they
+    # share its pixels. Strips are kept in the media cache and shared by every animation of the same media, size and
+    # angle, use FrameStrip.get() to obtain them
+
+    def __init__(self, frames, durations):
+        w, h = sum(frame.get_width() for frame in frames), max(frame.get_height() for frame in frames)
+        super().__init__((w, h), pygame.SRCALPHA)
+
+        x = 0
+        self._frames = []
+        for frame in frames:
+            super().blit(frame, (x, 0))
+            self._frames.append(self.subsurface((x, 0, *frame.get_size())))
+            x += frame.get_width()
+        self._durations = tuple(durations)
+
+    @classmethod
+    def get(cls, filename, size=None, angle=0, keep_alpha=True):
+        key = (filename, keep_alpha, size, angle)
+        if (strip := media_cache.get(key)) is not None:
+            return strip
+
+        frames = []
+        for _, frame in load_frames(filename, keep_alpha):  # in order of the manifest
+            if angle:
+                frame = pygame.transform.rotate(frame, angle)
+            if size:
+                frame = pygame.transform.scale(frame, size)
+            frames.append(frame)
+        strip = cls(frames, MediaManifest.get().get_entry(filename).durations)
+        media_cache.put(key, strip)
+        return strip
+
+    @property
+    def frames(self):
+        return self._frames.copy()
+
+    @property
+    def durations(self):
+        return self._durations
+
+    def get_frame(self, idx):
+        return self._frames[idx]
+
+    def __len__(self):
+        return len(self._frames)
+
+
+class Animation:
+    # Playback of a frame strip. Only the start time is stored, current frame is calculated from the shared clock.
+    # Animation starts when its first frame is requested, unless it is restarted explicitly
+
+    def __init__(self, filename, loop=False, size=None, angle=0, keep_alpha=True, frame_duration=None):
+        self._strip = FrameStrip.get(filename, size=size, angle=angle, keep_alpha=keep_alpha)
+        durations = (frame_duration,) * len(self._strip) if frame_duration else self._strip.durations
+
+        self._ends = tuple(itertools.accumulate(durations))  # time of the end of every frame since start
+        self._loop = loop
+        self._start = None
+
+    def restart(self):
+        self._start = clock.now
+
+    def _get_elapsed(self):
+        if self._start is None:
+            self._start = clock.now
+        return clock.now - self._start
+
+    @property
+    def finished(self):  # looped animations are never finished
+        return not self._loop and self._get_elapsed() >= self._ends[-1]
+
+    def get_frame(self):
+        # not looped animation repeats its last frame after finish
+        elapsed = self._get_elapsed()
+        if self._loop:
+            elapsed %= self._ends[-1]
+
+        return self._strip.get_frame(min(bisect.bisect_right(self._ends, elapsed), len(self._strip) - 1))
@@ -0,0 +1,443 @@
+__all__ = (
+    'run_scenario',
+    'run_startup',
+    'run_benchmark',
+    'compare',
+    'SCENARIOS',
+    'STARTUP'
+)
+
+import argparse
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import constants
+from constants import BASE_DIR, DB_URL, SCREEN_WIDTH, SCREEN_HEIGHT, Media
+
+BASELINE_URL = os.path.join(BASE_DIR, 'benchmark.baseline.json')  # saved by "python source/benchmark.py --save"
+BENCHMARK_LOGIN, BENCHMARK_PASSWORD = 'benchmark', 'benchmark'
+USER_LEVELS_NUM = 300  # seeded into the copy of the database, so UserLevelsSurface has pages to flip
+IDLE_FRAMES = 300
+
+# metrics compared with the baseline: name: absolute slack added to the relative tolerance (so noise of tiny values,
+# e.g. a frame of the idle menu, is not reported as a regression)
+COMPARED_METRICS = {
+    'frame_p95_ms': 1.0,
+    'frame_p99_ms': 2.0,
+    'peak_rss_mb': 8.0,
+    'db_queries': 0,
+    'db_render_path_queries': 0,  # queries run by handle() phases of surfaces, see diagnostics.QueryStats
+    'time_to_first_frame_ms': 50,
+    'time_to_interactive_ms': 50,
+    'surface_kb_per_frame': 4.0  # only if allocations are tracked
+}
+
+
+class _Input:
+    # Scripted input of a scenario. Cursor position is faked (pygame.mouse.get_pos() is patched, the dummy video driver
+    # has no mouse), presses and keys are posted to the queue of pygame, so they pass through the dispatcher as real
+    # ones
+
+    def __init__(self, pygame):
+        self._pygame = pygame
+        self.cursor = (0, 0)
+        pygame.mouse.get_pos = lambda: self.cursor
+
+    def move(self, pos):
+        self.cursor = tuple(map(int, pos))
+        self._pygame.event.post(self._pygame.event.Event(self._pygame.MOUSEMOTION, pos=self.cursor, rel=(0, 0),
+                                                         buttons=(0, 0, 0)))
+
+    def click(self, pos, button=1):
+        # generator: press in the first frame and release in the next one
+        self.move(pos)
+        self._pygame.event.post(self._pygame.event.Event(self._pygame.MOUSEBUTTONDOWN, pos=self.cursor, button=button))
+        yield
+        self._pygame.event.post(self._pygame.event.Event(self._pygame.MOUSEBUTTONUP, pos=self.cursor, button=button))
+        yield
+
+    def type(self, text):
+        # generator: one character per frame
+        for char in text:
+            self._pygame.event.post(self._pygame.event.Event(self._pygame.KEYDOWN, key=ord(char), unicode=char, mod=0,
+                                                             scancode=0))
+            yield
+
+    def press_key(self, key, unicode=''):
+        self._pygame.event.post(self._pygame.event.Event(self._pygame.KEYDOWN, key=key, unicode=unicode, mod=0,
+                                                         scancode=0))
+
+
+def _idle(frames=IDLE_FRAMES):
+    for _ in range(frames):
+        yield
+
+
+def _wait(condition, limit=600):
+    # generator: frames until the condition is met (e.g. a worker has completed), but no more than limit
+    for _ in range(limit):
+        if condition():
+            return
+        yield
+
+
+def _start_session(main):
+    # skips authorization, as if the benchmark user has logged in
+    from utils import bus, DataBase
+    from constants import Messages
+
+    bus.post(Messages.START_SESSION, DataBase().get_uid(BENCHMARK_LOGIN))
+    bus.post(Messages.UNFREEZE_CWW, main._freezers[0])
+    yield
+
+
+def _open(main, window):
+    from utils import bus
+    from constants import Messages
+
+    bus.post(Messages.RUN_WITH_UID, window)
+    yield
+    yield
+
+
+# Scenarios are generators of frames: every yield runs one frame of the game, the input for the frame is prepared
+# before the yield. Every scenario starts at the menu after warm up, the authorization form is shown above it.
+# Modules of the game are imported within scenarios, since utils must not be imported before the database is copied
+
+def _menu_idle(_main, _input):
+    yield from _idle()
+
+
+def _login(main, input_):
+    form = main._freezers[0].current_tab
+    for field, text in zip(form.fields, (BENCHMARK_LOGIN, BENCHMARK_PASSWORD)):
+        yield from input_.click(field.get_absolute_rect().center)
+        yield from input_.type(text)
+    yield from input_.click(form.submit_button.get_absolute_rect().center)
+    yield from _wait(lambda: main._session)  # the password is checked on a worker
+    yield from _idle(60)
+
+
+def _levels_hover(main, input_):
+    from levels import Levels
+
+    yield from _start_session(main)
+    yield from _open(main, Levels)
+    for y in range(0, SCREEN_HEIGHT, 40):  # sweeps the grid of levels buttons row by row
+        for x in range(0, SCREEN_WIDTH, 80):
+            input_.move((x, y))
+            yield
+
+
+def _level_restart(main, input_):
+    import pygame
+    from levels import Levels
+
+    yield from _start_session(main)
+    yield from _open(main, Levels)
+    yield from input_.click(main._windows_stack[-1]._buttons[0].get_absolute_rect().center)  # the first system level
+    yield
+    level = main._windows_stack[-1]
+    yield from _wait(lambda: level._setup.done)
+    input_.move((0, 0))
+    for _ in range(5):
+        input_.press_key(pygame.K_SPACE, ' ')  # any key starts the level
+        yield from _idle(60)
+        level.restart()  # as the restart button of the panel does
+        yield
+
+
+def _editor_200(main, input_):
+    from editor import Editor
+
+    yield from _start_session(main)
+    yield from _open(main, Editor)
+    editor = main._windows_stack[-1]
+    panel = editor._tiles_panel
+
+    input_.move(panel.get_absolute_rect().center)  # hovered panel is maximized and lists the unlocked tiles
+    yield from _wait(lambda: panel._available_tiles)
+    block = next(tile for tile in panel._available_tiles if tile.factory.__name__ == 'Block')
+    yield from _idle(30)
+    yield from input_.click(block.get_absolute_rect().center)
+    input_.move((SCREEN_WIDTH // 2, 0))
+    yield from _wait(lambda: panel.is_minimized())
+
+    field = editor._field
+    cell_w, cell_h = field.get_rect().w / field.cols, field.get_rect().h / field.rows
+    for idx in range(200):  # every cell of the field (10 rows and 20 columns)
+        row, col = divmod(idx, field.cols)
+        yield from input_.click((cell_w * (col + 0.5), cell_h * (row + 0.5)))
+    yield from _idle()
+
+
+def _user_levels_paging(main, input_):
+    from levels import Levels
+
+    yield from _start_session(main)
+    yield from _open(main, Levels)
+    yield from input_.click(main._windows_stack[-1].user_levels_list_button.get_absolute_rect().center)
+    yield
+    surface = main._freezers[-1]
+    for button in (surface._button_next_page,) * 10 + (surface._button_previous_page,) * 10:
+        yield from input_.click(button.get_absolute_rect().center)
+        yield from _idle(10)
+
+
+SCENARIOS = {
+    'menu_idle': _menu_idle,
+    'login': _login,
+    'levels_hover': _levels_hover,
+    'level_restart': _level_restart,
+    'editor_200': _editor_200,
+    'user_levels_paging': _user_levels_paging
+}
+STARTUP = 'startup'  # not a scenario of frames, see run_startup()
+
+
+def _seed(database):
+    # the same data for every scenario: a user who has completed every system level (so every tile is unlocked)
+    # and user levels to be paged
+    database.create_user(BENCHMARK_LOGIN, BENCHMARK_PASSWORD)
+    uid = database.get_uid(BENCHMARK_LOGIN)
+    for level_id, _ in database.get_system_levels():
+        database.save_completion(level_id, uid, 60.0)
+
+    fdata = database.get_level_field_data(database.get_system_levels()[0][0])
+    for idx in range(USER_LEVELS_NUM):
+        database.create_level(f'benchmark {idx}', fdata, uid, Media.PACKS[idx % len(Media.PACKS)])
+
+
+def _get_peak_rss_mb():
+    try:
+        import resource
+    except ImportError:  # not available on Windows
+        return None
+
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 1024 ** 2 if sys.platform == 'darwin' else peak / 1024  # bytes on macOS, kilobytes elsewhere
+
+
+def _get_percentile(samples, percent):
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(len(samples) * percent / 100))]
+
+
+def run_scenario(name, track_allocations=False):
+    """
+    runs the scenario in the current process, must be called once per process (see run_benchmark()), since the game
+    is booted with a temporary copy of the database. Tracking of Surface allocations slows frames down, so frame times
+    of such runs are not comparable with the ones of usual runs
+
+    :returns: :class:`dict` - metrics of the scenario
+    """
+
+    os.environ['SDL_VIDEODRIVER'] = 'dummy'
+    os.environ['SDL_AUDIODRIVER'] = 'dummy'
+
+    import sqlite3
+    connect = sqlite3.connect
+    queries, lock = [0], threading.Lock()
+
+    def _count(_statement):
+        with lock:
+            queries[0] += 1
+
+    def _connect(*args, **kwargs):  # every statement of every connection (including the ones of workers) is counted
+        connection = connect(*args, **kwargs)
+        connection.set_trace_callback(_count)
+        return connection
+
+    with tempfile.TemporaryDirectory() as tmp:
+        # must be set before utils is imported, since it imports DB_URL by value. Levels are opened without artefacts,
+        # as they are for the first time
+        constants.DB_URL = shutil.copy(DB_URL, tmp)
+        constants.LEVELS_CACHE_DIR = os.path.join(tmp, 'levels.cache')
+        sqlite3.connect = _connect
+
+        import runpy
+        import pygame
+        from diagnostics import allocations, query_stats
+        from precompute import level_artefacts
+        from utils import DataBase
+
+        pygame.init()
+        _seed(DataBase())
+        DataBase.flush()
+
+        main = runpy.run_path(os.path.join(os.path.dirname(__file__), '__main__.py'), run_name='benchmark')['Main']()
+        input_ = _Input(pygame)
+        main._warm_up()
+        main._clock = type('_NoWaitClock', (), {'tick': staticmethod(lambda _fps=0: 0)})()  # frames are not capped
+        for _ in range(2):  # the menu opens the authorization form, which lays out its fields in the next frame
+            main._run_frame()
+
+        queries[0] = 0
+        query_stats.reset()
+        query_stats.guard = 'count'
+        if track_allocations:
+            allocations.enable()
+        durations = []
+        started = time.perf_counter()
+        for _ in SCENARIOS[name](main, input_):
+            start = time.perf_counter()
+            main._run_frame()
+            durations.append(time.perf_counter() - start)
+        elapsed = time.perf_counter() - started
+        allocations.disable()
+
+        DataBase.flush()
+        level_artefacts.close(wait=True)  # the directory of artefacts is removed afterwards
+        pygame.quit()
+
+    frames_ms = [duration * 1000 for duration in durations]
+    results = {
+        'frames': len(frames_ms),
+        'elapsed_s': elapsed,
+        'frame_p50_ms': _get_percentile(frames_ms, 50),
+        'frame_p95_ms': _get_percentile(frames_ms, 95),
+        'frame_p99_ms': _get_percentile(frames_ms, 99),
+        'frame_max_ms': max(frames_ms),
+        'peak_rss_mb': _get_peak_rss_mb(),
+        'db_queries': queries[0],
+        'db_render_path_queries': query_stats.get_render_path_count()
+    }
+    if track_allocations:
+        report = allocations.get_report(limit=10)
+        results['surface_allocations_per_frame'] = report['allocations_per_frame']
+        results['surface_kb_per_frame'] = report['bytes_per_frame'] / 1024
+        results['allocation_sites'] = report['sites']
+
+    return results
+
+
+def run_startup(started):
+    """
+    boots the game in the current process as a kiosk does. Time is measured since started (time.time() of the parent
+    process before the process has been spawned, so start of the interpreter is counted too) to the first frame (of
+    warm up), to the first frame of the menu (interactive) and until media of other windows is loaded
+
+    :returns: :class:`dict` - metrics of the startup
+    """
+
+    os.environ['SDL_VIDEODRIVER'] = 'dummy'
+    os.environ['SDL_AUDIODRIVER'] = 'dummy'
+
+    with tempfile.TemporaryDirectory() as tmp:
+        constants.DB_URL = shutil.copy(DB_URL, tmp)
+
+        import runpy
+        import pygame
+
+        presented = []
+        flip = pygame.display.flip
+
+        def _flip():
+            flip()
+            presented.append(time.time())
+
+        pygame.init()
+        pygame.display.flip = _flip
+        main = runpy.run_path(os.path.join(os.path.dirname(__file__), '__main__.py'), run_name='benchmark')['Main']()
+        main._warm_up()
+        main._clock = type('_NoWaitClock', (), {'tick': staticmethod(lambda _fps=0: 0)})()
+        main._run_frame()
+        interactive = presented[-1]
+        imported = [module for module in ('levels', 'editor', 'level', 'tiles', 'bcrypt') if module in sys.modules]
+        while not main._media_task.done:
+            main._run_frame()
+        pygame.quit()
+
+    return {
+        'time_to_first_frame_ms': (presented[0] - started) * 1000,
+        'time_to_interactive_ms': (interactive - started) * 1000,
+        'time_to_media_loaded_ms': (presented[-1] - started) * 1000,
+        'imported_at_interactive': imported  # modules which are expected to be imported on the first use only
+    }
+
+
+def run_benchmark(names=(*SCENARIOS, STARTUP), track_allocations=False):
+    """
+    runs every scenario in a separate process, so scenarios do not share caches and peak memory
+
+    :returns: :class:`dict` - results of the benchmark, which can be saved as a baseline
+    """
+
+    scenarios = {}
+    for name in names:
+        command = (sys.executable, __file__, '--child', name, '--started', str(time.time()),
+                   *(('--allocations',) if track_allocations else ()))
+        completed = subprocess.run(command, capture_output=True, text=True, cwd=BASE_DIR)
+        if completed.returncode:
+            raise RuntimeError(f'Scenario "{name}" has failed:\n{completed.stderr}')
+        scenarios[name] = json.loads(completed.stdout.splitlines()[-1])
+
+    return {
+        'environment': {'python': platform.python_version(), 'platform': platform.platform()},
+        'scenarios': scenarios
+    }
+
+
+def compare(results, baseline, tolerance=0.25):
+    """
+    compares the results with the baseline, scenarios and metrics missing in any of them are skipped
+
+    :returns: :class:`list[str]` - descriptions of regressions
+    """
+
+    regressions = []
+    for name, metrics in results['scenarios'].items():
+        for metric, slack in COMPARED_METRICS.items():
+            value, base = metrics.get(metric), baseline['scenarios'].get(name, {}).get(metric)
+            if value is None or base is None:
+                continue
+            if value > base * (1 + tolerance) + slack:
+                regressions.append(f'{name}: {metric} {value:.2f} > {base:.2f} (baseline)')
+
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Headless benchmark of scripted scenarios of the game')
+    parser.add_argument('scenarios', nargs='*', help=f'any of {", ".join((*SCENARIOS, STARTUP))} (all by default)')
+    parser.add_argument('--child', help=argparse.SUPPRESS)
+    parser.add_argument('--started', type=float, help=argparse.SUPPRESS)
+    parser.add_argument('--save', action='store_true', help=f'save results as the baseline ("{BASELINE_URL}")')
+    parser.add_argument('--output', help='write results (JSON) to the file')
+    parser.add_argument('--allocations', action='store_true',
+                        help='track Surface allocations by call site (frames are slower meanwhile)')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='allowed relative growth of compared metrics')
+    args = parser.parse_args()
+
+    if unknown := set(args.scenarios) - {*SCENARIOS, STARTUP}:
+        parser.error(f'unknown scenarios: {", ".join(sorted(unknown))}')
+
+    if args.child:
+        print(json.dumps(run_startup(args.started) if args.child == STARTUP else run_scenario(args.child,
+                                                                                                args.allocations)))
+        sys.exit()
+
+    results = run_benchmark(args.scenarios or (*SCENARIOS, STARTUP), args.allocations)
+    dumped = json.dumps(results, indent=2)
+    print(dumped)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as file:
+            file.write(dumped)
+
+    if args.save:
+        with open(BASELINE_URL, 'w', encoding='utf-8') as file:
+            file.write(dumped)
+        print(f'Baseline has been saved to "{BASELINE_URL}"')
+    elif os.path.exists(BASELINE_URL):
+        with open(BASELINE_URL, encoding='utf-8') as file:
+            if regressions := compare(results, json.load(file), args.tolerance):
+                print('Regressions:', *regressions, sep='\n', file=sys.stderr)
+                sys.exit(1)
+        print('No regressions')
@@ -0,0 +1,113 @@
+__all__ = (
+    'MediaBundle',
+    'build_bundle'
+)
+
+import json
+import mmap
+import os
+import struct
+
+import pygame
+
+from constants import MEDIA_URL, MEDIA_BUNDLE_URL
+
+# Bundle layout: magic, version, index length (little-endian uint32), JSON index (padded to 4 bytes), pixel data.
+# Index: {"files": {relative path: [offset, width, height]}}, directories of frames are described by the manifest.
+# Pixel data of every file is stored decoded in the format of surfaces converted with convert_alpha() (BGRA bytes,
+# which is ARGB8888, 4 bytes per pixel, rows without padding), so it can be passed to pygame.image.frombuffer() as it
+# is and surfaces are not converted afterwards (see is_display_format()). Offsets are counted from the start of pixel
+# data
+_MAGIC = b'PSBUNDLE'
+_VERSION = 3
+_HEADER = struct.Struct('<8sII')
+
+
+class MediaBundle:
+    # Read-only view of the bundle built by build_bundle(). The file is memory-mapped, so surfaces returned by load()
+    # share memory with the mapping (no copying and no decoding), which means the bundle must stay opened while they
+    # are in use. Media is expected to be rebuilt into the bundle on every change of MEDIA_URL directory
+
+    _instance = ...
+    _display_masks = None  # of surfaces converted with convert_alpha(), known once the display is set
+
+    def __init__(self, path):
+        with open(path, 'rb') as file:
+            self._mapping = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, version, index_length = _HEADER.unpack_from(self._mapping)
+        if magic != _MAGIC or version != _VERSION:
+            raise ValueError(f'"{path}" is not a media bundle of version {_VERSION}')
+
+        index = json.loads(self._mapping[_HEADER.size:_HEADER.size + index_length])
+        self._files = index['files']
+        self._view = memoryview(self._mapping)[_HEADER.size + index_length:]
+
+    @classmethod
+    def get(cls):
+        # opened bundle of MEDIA_BUNDLE_URL. Returns None if it has not been built (media is loaded from files then)
+        if cls._instance is Ellipsis:
+            try:
+                cls._instance = cls(MEDIA_BUNDLE_URL)
+            except (OSError, ValueError):
+                cls._instance = None
+        return cls._instance
+
+    @classmethod
+    def is_display_format(cls, surface):
+        """
+        tells whether the surface is in the format convert_alpha() would convert it to, so converting it would only copy
+        its pixels (and, for surfaces of the bundle, would copy them out of the mapping). Must be called from the main
+        thread once the display is set
+        """
+
+        if cls._display_masks is None:
+            cls._display_masks = pygame.Surface((1, 1), pygame.SRCALPHA).convert_alpha().get_masks()
+        return surface.get_bitsize() == 32 and surface.get_masks() == cls._display_masks
+
+    def __contains__(self, rel):
+        return os.path.normpath(rel) in self._files
+
+    def load(self, rel):
+        offset, w, h = self._files[os.path.normpath(rel)]
+        return pygame.image.frombuffer(self._view[offset:offset + w * h * 4], (w, h), 'BGRA')
+
+
+def build_bundle(media_dir=MEDIA_URL, path=MEDIA_BUNDLE_URL):
+    """
+    decodes every image of media_dir (including frames in directories) and packs them into one file
+
+    :returns: :class:`int` - number of packed images
+    """
+
+    files, blobs = {}, []
+    offset = 0
+
+    for root, _, filenames in os.walk(media_dir):
+        rel_root = os.path.relpath(root, media_dir)
+
+        for filename in filenames:
+            rel = os.path.normpath(os.path.join(rel_root, filename))
+            try:
+                image = pygame.image.load(os.path.join(root, filename))
+            except pygame.error:  # not an image (or not supported format)
+                continue
+            data = pygame.image.tobytes(image, 'BGRA')
+            files[rel] = [offset, *image.get_size()]
+            blobs.append(data)
+            offset += len(data)
+
+    index = json.dumps({'files': files}, ensure_ascii=False).encode('utf-8')
+    index += b' ' * (-(_HEADER.size + len(index)) % 4)  # pixel data is aligned to 4 bytes
+
+    with open(path, 'wb') as file:
+        file.write(_HEADER.pack(_MAGIC, _VERSION, len(index)))
+        file.write(index)
+        for data in blobs:
+            file.write(data)
+
+    return len(files)
+
+
+if __name__ == '__main__':
+    print(f'{build_bundle()} images have been packed into "{MEDIA_BUNDLE_URL}"')
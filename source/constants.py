@@ -1,40 +1,85 @@
 __all__ = (
     'BASE_DIR',
     'DB_URL',
+    'BCRYPT_ROUNDS',
+    'MEDIA_CACHE_BUDGET',
+    'MEDIA_CACHE_PRESSURE',
+    'PACK_IDLE_TIMEOUT',
+    'FRAME_TASKS_BUDGET',
     'FPS',
     'SCREEN_SIZE',
     'SCREEN_WIDTH',
     'SCREEN_HEIGHT',
     'MEDIA_URL',
-    'UserEvents',
+    'MEDIA_BUNDLE_URL',
+    'MEDIA_MANIFEST_URL',
+    'ALLOCATIONS_REPORT_URL',
+    'PROFILES_DIR',
+    'PROFILE_ENV',
+    'PROFILE_FRAMES',
+    'QUERY_STATS_URL',
+    'DB_GUARD_ENV',
+    'SURFACES_REPORT_URL',
+    'LEVELS_CACHE_DIR',
+    'THUMBNAIL_SIZE',
+    'LEAK_CHECK_INTERVAL',
+    'LEAK_CHECK_SNAPSHOTS',
+    'Messages',
     'Media'
 )
 
 import os
 from pathlib import Path
 
-import pygame
-
 BASE_DIR = Path(__file__).parent.parent
 MEDIA_URL = os.path.join(BASE_DIR, 'media')
+MEDIA_BUNDLE_URL = os.path.join(BASE_DIR, 'media.bundle')  # optional, built by "python source/bundle.py"
+MEDIA_MANIFEST_URL = os.path.join(BASE_DIR, 'media.manifest.json')  # built by "python source/manifest.py"
 DB_URL = os.path.join(BASE_DIR, 'db.sqlite3')
+ALLOCATIONS_REPORT_URL = os.path.join(BASE_DIR, 'allocations.report.json')  # written when tracking is toggled off (F4)
+PROFILES_DIR = os.path.join(BASE_DIR, 'profiles')  # captured by F5 or PROFILE_ENV, see diagnostics.ProfileCapture
+QUERY_STATS_URL = os.path.join(BASE_DIR, 'queries.report.json')  # statistics of database queries, exported by F6
+SURFACES_REPORT_URL = os.path.join(BASE_DIR, 'surfaces.report.json')  # live surfaces, exported by F7
+LEVELS_CACHE_DIR = os.path.join(BASE_DIR, 'levels.cache')  # derived data of levels, see precompute.LevelArtefacts
 
 FPS = 60
+# cost factor of password hashing (bcrypt.gensalt(rounds=...)), every increment doubles the time of hashing.
+# Affects only new passwords, since the cost of the saved ones is stored inside their hashes
+BCRYPT_ROUNDS = 12
+# maximum of memory (in bytes) used by decoded media, the least recently used images are evicted above it
+MEDIA_CACHE_BUDGET = 256 * 1024 * 1024
+# share of the budget above which packs that are not in use are unloaded without waiting for PACK_IDLE_TIMEOUT
+MEDIA_CACHE_PRESSURE = 0.75
+# seconds after which media of a pack that is not used by any window is unloaded
+PACK_IDLE_TIMEOUT = 30
+# frames profiled on F5. If the environment variable is set (to a number of frames), frames after warm up are profiled
+PROFILE_FRAMES = 120
+PROFILE_ENV = 'PIXELSLIME_PROFILE'
+# mode of the guard of queries run by draw() of surfaces (see diagnostics.QueryStats): "count", "warn" or "raise"
+DB_GUARD_ENV = 'PIXELSLIME_DB_GUARD'
+# live surfaces are counted every LEAK_CHECK_INTERVAL seconds, classes which number has grown in every of the last
+# LEAK_CHECK_SNAPSHOTS counts are reported as leaking
+LEAK_CHECK_INTERVAL = 60
+LEAK_CHECK_SNAPSHOTS = 5
 SCREEN_SIZE = SCREEN_WIDTH, SCREEN_HEIGHT = (1920, 1080)
+# size of thumbnails of levels, the aspect ratio is the one of the field of levels
+THUMBNAIL_SIZE = (240, 128)
+# seconds of a frame given to deferred work of the main thread (see utils.Scheduler)
+FRAME_TASKS_BUDGET = 0.004
 
 
-class UserEvents:
-    # pygame has limitations on events num: maximum of 9 events is only available (ids from 24 to 32),
-    # so this class should contain only vital attributes
-    SET_CWW = pygame.USEREVENT + 0  # attrs: window
-    CLOSE_CWW = pygame.USEREVENT + 1  # attrs: window
-    FREEZE_CWW = pygame.USEREVENT + 2  # attrs: freezer
-    UNFREEZE_CWW = pygame.USEREVENT + 3  # attrs: freezer
-    START_SESSION = pygame.USEREVENT + 4  # attrs: uid
-    SAVE_LEVEL = pygame.USEREVENT + 5  # attrs: level_id, fdata, pack
-    DELETE_LEVEL = pygame.USEREVENT + 6  # attrs: level_id
-    LEVEL_COMPLETED = pygame.USEREVENT + 7  # attrs: level_id, time
-    RUN_WITH_UID = pygame.USEREVENT + 8  # attrs: runner
+class Messages:
+    # topics of the message bus (see utils.MessageBus), unlike pygame user events they are not limited in number.
+    # Arguments are passed positionally in the listed order
+    SET_CWW = 0  # args: window
+    CLOSE_CWW = 1  # args: -
+    FREEZE_CWW = 2  # args: freezer
+    UNFREEZE_CWW = 3  # args: freezer
+    START_SESSION = 4  # args: uid
+    SAVE_LEVEL = 5  # args: name, fdata, pack, on_error (None if not required)
+    DELETE_LEVEL = 6  # args: level_id, on_error (None if not required)
+    LEVEL_COMPLETED = 7  # args: level_id, time
+    RUN_WITH_UID = 8  # args: runner
 
 
 class Media:
@@ -57,8 +102,11 @@ class Media:
     ROCK_PACK = 'rock_pack'
     SKY_PACK = 'sky_pack'
     PURPLE_PACK = 'purple_pack'
+    PACKS = (LAVA_PACK, ROCK_PACK, SKY_PACK, PURPLE_PACK)
 
     HERO_STATIC = '{}/hero.png'
+    HERO_FLY = '{}/fly.gif'
+    HERO_LANDING = '{}/landing.gif'
     HERO_ARROW_VECTOR = '{}/arrow_vector.png'
     BACKGROUND = '{}/background.png'
     BLOCK = '{}/block.png'
@@ -76,3 +124,7 @@ class Media:
     CLOCK = 'clock.png'
     LOCKED = 'locked.png'
     UNLOCKED = 'unlocked.png'
+
+    # media of the menu and of the authorization form, loaded before the first frame of the menu (the rest is loaded
+    # after it, see Main._warm_up())
+    STARTUP = (TITLE, LABEL_EDITOR, LABEL_LEVELS, LEVELS_PREVIEW, WRENCH, CLOSE_WINDOW, EYE)
@@ -0,0 +1,594 @@
+__all__ = (
+    'FrameTimer',
+    'LatencyMeter',
+    'SurfaceAllocations',
+    'ProfileCapture',
+    'QueryStats',
+    'RenderPathQueryError',
+    'SurfaceRegistry',
+    'frame_timer',
+    'latency',
+    'allocations',
+    'profile_capture',
+    'query_stats',
+    'surface_registry',
+    'timed',
+    'timed_methods'
+)
+
+import cProfile
+import inspect
+import json
+import os
+import pstats
+import re
+import sys
+import threading
+import time
+import warnings
+import weakref
+from collections import deque
+from functools import wraps, lru_cache
+
+import pygame
+
+from constants import (ALLOCATIONS_REPORT_URL, PROFILES_DIR, PROFILE_FRAMES, QUERY_STATS_URL, SURFACES_REPORT_URL,
+                       LEAK_CHECK_INTERVAL, LEAK_CHECK_SNAPSHOTS)
+
+
+def _summarize(samples):
+    if not samples:
+        return {'last': None, 'mean': None, 'max': None, 'samples': 0}
+    return {'last': samples[-1], 'mean': sum(samples) / len(samples), 'max': max(samples), 'samples': len(samples)}
+
+
+class FrameTimer:
+    # Durations (in seconds) of the phases of the last frames and time spent by subsystems within them. Main calls
+    # begin() at the start of a frame and mark() at the end of every phase, so a phase lasts from the previous mark (or
+    # begin) to its mark. Subsystems are measured by functions decorated with timed(), only calls from the main thread
+    # are counted (the ones from workers do not delay frames) and nested calls of the same subsystem are counted once.
+    # Nothing is measured while the timer is disabled, except for a check of the flag
+
+    PHASES = ('input', 'window', 'freezers', 'render', 'present', 'end', 'idle')
+
+    def __init__(self, size=240):
+        self.enabled = False
+
+        self._size = size
+        self._durations = {phase: deque(maxlen=size) for phase in self.PHASES}
+        self._totals = deque(maxlen=size)
+        self._subsystems = {}  # name: time spent within the last frames
+        self._current = {}  # name: time spent within the current frame
+        self._running = set()  # subsystems being measured
+        self._main_thread = threading.get_ident()
+
+        self._frame_start = None
+        self._last_mark = None
+
+    def toggle(self):
+        self.enabled = not self.enabled
+        self._frame_start = None  # a frame which has been started before the toggle is not complete
+
+    def begin(self):
+        if not self.enabled:
+            return
+
+        now = time.perf_counter()
+        if self._frame_start is not None:
+            self._totals.append(now - self._frame_start)
+            for name, durations in self._subsystems.items():
+                durations.append(self._current.get(name, 0))
+        self._current.clear()
+        self._frame_start = self._last_mark = now
+
+    def mark(self, phase):
+        if not self.enabled or self._frame_start is None:
+            return
+
+        now = time.perf_counter()
+        self._durations[phase].append(now - self._last_mark)
+        self._last_mark = now
+
+    def timed(self, name):
+        """
+        decorator measuring time spent by the function as a part of the subsystem
+        """
+
+        self._subsystems.setdefault(name, deque(maxlen=self._size))
+
+        def decorator(fn):
+            @wraps(fn)
+            def __wrapper__(*args, **kwargs):
+                if not self.enabled or name in self._running or threading.get_ident() != self._main_thread:
+                    return fn(*args, **kwargs)
+
+                self._running.add(name)
+                start = time.perf_counter()
+                try:
+                    return fn(*args, **kwargs)
+                finally:
+                    self._current[name] = self._current.get(name, 0) + time.perf_counter() - start
+                    self._running.discard(name)
+
+            return __wrapper__
+
+        return decorator
+
+    def get_last(self, phase):
+        return self._durations[phase][-1] if self._durations[phase] else 0
+
+    def get_history(self):
+        # durations of the phases of every of the last frames (oldest first)
+        return list(zip(*(self._durations[phase] for phase in self.PHASES)))
+
+    def get_percentiles(self, *percents):
+        # of total durations of the last frames
+        totals = sorted(self._totals)
+        if not totals:
+            return [0] * len(percents)
+        return [totals[min(len(totals) - 1, int(len(totals) * percent / 100))] for percent in percents]
+
+    def get_stats(self):
+        return {
+            **{phase: _summarize(durations) for phase, durations in self._durations.items()},
+            **{name: _summarize(durations) for name, durations in self._subsystems.items()}
+        }
+
+
+class LatencyMeter:
+    # Time from sampling of input (key or mouse button presses) to the presentation of the frame handling it ("input to
+    # photon", the return of pygame.display.flip() is taken as the photon) and to the first effect marked by the game
+    # logic (e.g. start of the hero flight). Time spent by events in the queue before sampling is not known to pygame,
+    # so it is not counted (up to one frame)
+
+    def __init__(self, size=120):
+        self._to_present = deque(maxlen=size)
+        self._to_effect = deque(maxlen=size)
+        self._input_at = None
+        self._effect_at = None
+
+    def input_sampled(self, has_input):
+        self._input_at = time.perf_counter() if has_input else None
+        self._effect_at = None
+
+    def mark_effect(self):
+        if self._input_at is not None and self._effect_at is None:
+            self._effect_at = time.perf_counter()
+
+    def presented(self):
+        if self._input_at is None:
+            return
+        self._to_present.append(time.perf_counter() - self._input_at)
+        if self._effect_at is not None:
+            self._to_effect.append(self._effect_at - self._input_at)
+        self._input_at = None
+
+    def get_stats(self):
+        return {'input_to_present': _summarize(self._to_present), 'input_to_effect': _summarize(self._to_effect)}
+
+
+class SurfaceAllocations:
+    # Surfaces allocated within frames by call site (file, line and function which has requested the surface, frames of
+    # constructors of the surface itself are skipped, as tracemalloc does with lineno statistics). BaseSurface reports
+    # itself on creation, pygame.Surface and functions of pygame.transform are replaced with reporting wrappers while
+    # the tracker is enabled. Only allocations of the main thread are counted (as in FrameTimer), surfaces created by C
+    # code (e.g. rendered text) are not seen. Disabled by default, since every allocation walks the stack
+
+    TRANSFORMS = ('scale', 'smoothscale', 'scale_by', 'smoothscale_by', 'rotate', 'rotozoom', 'flip', 'chop')
+
+    def __init__(self, size=240):
+        self.enabled = False
+
+        self._totals = deque(maxlen=size)  # (allocations, bytes) of every of the last frames
+        self._current = [0, 0]
+        self._sites = {}  # call site: [allocations, bytes] since enabling
+        self._frames = 0  # frames since enabling
+        self._originals = {}  # replaced attributes of pygame
+        self._main_thread = threading.get_ident()
+
+    def toggle(self):
+        self.disable() if self.enabled else self.enable()
+
+    def enable(self):
+        if self.enabled:
+            return
+
+        self._totals.clear()
+        self._current = [0, 0]
+        self._sites.clear()
+        self._frames = 0
+
+        tracker, original = self, pygame.Surface
+
+        class _Checks(type(original)):  # isinstance(x, pygame.Surface) keeps working with surfaces created before
+            def __instancecheck__(cls, instance):
+                return isinstance(instance, original)
+
+            def __subclasscheck__(cls, subclass):
+                return issubclass(subclass, original)
+
+        class _Surface(original, metaclass=_Checks):
+            def __init__(self, *args, **kwargs):
+                super().__init__(*args, **kwargs)
+                tracker.record(self)
+
+        self._originals[pygame, 'Surface'] = original
+        pygame.Surface = _Surface
+        for name in self.TRANSFORMS:
+            if hasattr(pygame.transform, name):
+                self._originals[pygame.transform, name] = original = getattr(pygame.transform, name)
+                setattr(pygame.transform, name, self._wrap(original))
+
+        self.enabled = True
+
+    def disable(self):
+        if not self.enabled:
+            return
+
+        self.enabled = False
+        for (module, name), original in self._originals.items():
+            setattr(module, name, original)
+        self._originals.clear()
+
+    def _wrap(self, transform):
+        @wraps(transform)
+        def __wrapper__(*args, **kwargs):
+            surface = transform(*args, **kwargs)
+            self.record(surface)
+            return surface
+
+        return __wrapper__
+
+    def next_frame(self):
+        if not self.enabled:
+            return
+
+        self._totals.append(tuple(self._current))
+        self._current = [0, 0]
+        self._frames += 1
+
+    @staticmethod
+    def _get_call_site(surface):
+        # constructors of the surface (e.g. chain of super().__init__) and wrappers of the tracker are skipped
+        frame = sys._getframe(1)
+        while frame.f_back is not None and (
+                frame.f_code.co_filename == __file__ or frame.f_locals.get('self') is surface):
+            frame = frame.f_back
+        return f'{os.path.basename(frame.f_code.co_filename)}:{frame.f_lineno} ({frame.f_code.co_name})'
+
+    def record(self, surface):
+        if not self.enabled or threading.get_ident() != self._main_thread:
+            return
+
+        size = surface.get_pitch() * surface.get_height()
+        site = self._sites.setdefault(self._get_call_site(surface), [0, 0])
+        site[0] += 1
+        site[1] += size
+        self._current[0] += 1
+        self._current[1] += size
+
+    def get_last(self):
+        # (allocations, bytes) of the last frame
+        return self._totals[-1] if self._totals else (0, 0)
+
+    def get_report(self, limit=20):
+        """
+        :returns: :class:`dict` - totals per frame and the call sites allocating the most bytes (per frame, since
+            enabling)
+        """
+
+        frames = max(self._frames, 1)
+        sites = sorted(self._sites.items(), key=lambda item: item[1][1], reverse=True)[:limit]
+        return {
+            'frames': self._frames,
+            'allocations_per_frame': sum(s[0] for s in self._sites.values()) / frames,
+            'bytes_per_frame': sum(s[1] for s in self._sites.values()) / frames,
+            'max_frame_bytes': max((total[1] for total in self._totals), default=0),
+            'sites': [{'site': site, 'allocations_per_frame': allocs / frames, 'bytes_per_frame': size / frames}
+                      for site, (allocs, size) in sites]
+        }
+
+    def format_report(self, limit=20):
+        report = self.get_report(limit)
+        lines = [f'Surface allocations within {report["frames"]} frames: {report["allocations_per_frame"]:.1f} '
+                 f'per frame, {report["bytes_per_frame"] / 1024:.1f} KB per frame',
+                 f'{"KB/frame":>10} {"allocs/frame":>12}  call site']
+        lines.extend(f'{site["bytes_per_frame"] / 1024:10.1f} {site["allocations_per_frame"]:12.2f}  {site["site"]}'
+                     for site in report['sites'])
+        return '\n'.join(lines)
+
+    def export(self, path=ALLOCATIONS_REPORT_URL, limit=100):
+        with open(path, 'w', encoding='utf-8') as file:
+            json.dump(self.get_report(limit), file, indent=2)
+
+
+class ProfileCapture:
+    # cProfile of the next frames. Frames are profiled separately by tag (class of the current working window), so
+    # every profile describes one window only. Profiles are written to PROFILES_DIR as "<time>-<tag>.prof" along with
+    # "<time>.txt" summary of the top cumulative functions. Main only checks requested once per frame, nothing is
+    # profiled until a capture is requested
+
+    SUMMARY_LIMIT = 30  # functions per tag in the summary
+
+    def __init__(self):
+        self.requested = 0  # number of frames to be captured
+
+    def request(self, frames=PROFILE_FRAMES):
+        self.requested = frames
+
+    def capture(self, run_frame, get_tag):
+        """
+        runs requested frames under the profiler. Profiles are written even if a frame raises (e.g. exits the game)
+
+        :param run_frame: Function running one frame
+        :param get_tag: Function returning the tag of the next frame
+        :returns: :class:`list[str]` - paths of the written files
+        """
+
+        frames, self.requested = self.requested, 0
+        profiles, counts = {}, {}
+        started = time.strftime('%Y%m%d-%H%M%S')
+
+        try:
+            for _ in range(frames):
+                tag = get_tag()
+                profile = profiles.setdefault(tag, cProfile.Profile())
+                counts[tag] = counts.get(tag, 0) + 1
+                profile.enable()
+                try:
+                    run_frame()
+                finally:
+                    profile.disable()
+        finally:
+            paths = self._write(started, profiles, counts)
+            print(f'Profile of {frames} frames has been written to', *paths, sep='\n', file=sys.stderr)
+
+        return paths
+
+    def _write(self, started, profiles, counts):
+        os.makedirs(PROFILES_DIR, exist_ok=True)
+        paths = []
+
+        summary_path = os.path.join(PROFILES_DIR, f'{started}.txt')
+        with open(summary_path, 'w', encoding='utf-8') as summary:
+            for tag, profile in profiles.items():
+                path = os.path.join(PROFILES_DIR, f'{started}-{tag}.prof')
+                profile.dump_stats(path)
+                paths.append(path)
+
+                summary.write(f'{tag}: {counts[tag]} frames, {os.path.basename(path)}\n')
+                pstats.Stats(profile, stream=summary).sort_stats(pstats.SortKey.CUMULATIVE).print_stats(
+                    self.SUMMARY_LIMIT)
+        paths.append(summary_path)
+
+        return paths
+
+
+class RenderPathQueryError(RuntimeError):
+    pass
+
+
+@lru_cache(maxsize=256)
+def _get_fingerprint(sql):
+    # literals are replaced with "?" and lists of values are collapsed, so queries differing only in data are the same
+    sql = re.sub(r"'(?:[^']|'')*'", '?', sql)
+    sql = re.sub(r'\b\d+(?:\.\d+)?\b', '?', sql)
+    sql = re.sub(r'\(\s*\?(?:\s*,\s*\?)*\s*\)', '(...)', sql)
+    return ' '.join(sql.split())
+
+
+class QueryStats:
+    # Statistics of DataBase queries by fingerprint: number, time (of execution and fetching), rows and callers (class
+    # of the current working window, which Main sets every frame, or name of the worker thread). The guard reports
+    # queries run by any per-frame phase of a surface (handle(), draw(), eventloop() or update()) on the main thread,
+    # since the frame loop must not touch the database: "count" only counts them, "warn" warns and "raise" raises
+    # RenderPathQueryError. Queries of constructors of surfaces are not reported, since windows are constructed once.
+    # The guard walks the stack of every query, so it is disabled by default
+
+    GUARD_MODES = (None, 'count', 'warn', 'raise')
+
+    def __init__(self):
+        self.guard = None
+        self.window = None
+
+        self._queries = {}  # fingerprint: statistics
+        self._lock = threading.Lock()  # queries are run by workers too
+        self._main_thread = threading.get_ident()
+
+    def reset(self):
+        with self._lock:
+            self._queries.clear()
+
+    FRAME_PHASES = ('handle', 'draw', 'eventloop', 'update')
+
+    @classmethod
+    def _get_frame_phase(cls):
+        # (surface, name of the phase) which has run the query, None if the query is run by a constructor of a surface
+        # or out of surfaces
+        frame = sys._getframe(2)
+        while frame is not None:
+            if frame.f_code.co_name in (*cls.FRAME_PHASES, '__init__') and isinstance(
+                    surface := frame.f_locals.get('self'), pygame.Surface):
+                return (surface, frame.f_code.co_name) if frame.f_code.co_name != '__init__' else None
+            frame = frame.f_back
+
+    def check(self, sql):
+        """
+        reports the query to the guard, must be called before the query is executed
+        """
+
+        if self.guard is None or threading.get_ident() != self._main_thread:
+            return
+        if (phase := self._get_frame_phase()) is None:
+            return
+        surface, name = phase
+
+        fingerprint = _get_fingerprint(sql)
+        with self._lock:
+            stats = self._get(fingerprint)
+            stats['render_path'][type(surface).__name__] = stats['render_path'].get(type(surface).__name__, 0) + 1
+
+        message = f'Query in the render path ({type(surface).__name__}.{name}): {fingerprint}'
+        if self.guard == 'raise':
+            raise RenderPathQueryError(message)
+        if self.guard == 'warn':
+            warnings.warn(message, RuntimeWarning, stacklevel=6)
+
+    def _get(self, fingerprint):
+        return self._queries.setdefault(fingerprint, {'count': 0, 'seconds': 0, 'max_seconds': 0, 'rows': 0,
+                                                      'callers': {}, 'render_path': {}})
+
+    def record(self, sql, duration, rows):
+        """
+        :returns: :class:`str` - fingerprint of the query, fetched rows are added to it by :meth:`add_fetched`
+        """
+
+        fingerprint = _get_fingerprint(sql)
+        caller = self.window if threading.get_ident() == self._main_thread else threading.current_thread().name
+        with self._lock:
+            stats = self._get(fingerprint)
+            stats['count'] += 1
+            stats['seconds'] += duration
+            stats['max_seconds'] = max(stats['max_seconds'], duration)
+            stats['rows'] += rows
+            stats['callers'][caller] = stats['callers'].get(caller, 0) + 1
+        return fingerprint
+
+    def add_fetched(self, fingerprint, duration, rows):
+        with self._lock:
+            stats = self._get(fingerprint)
+            stats['seconds'] += duration
+            stats['rows'] += rows
+
+    def get_render_path_count(self):
+        with self._lock:
+            return sum(sum(stats['render_path'].values()) for stats in self._queries.values())
+
+    def get_stats(self):
+        # by total time, the slowest first
+        with self._lock:
+            return sorted(({'query': fingerprint, **stats, 'callers': dict(stats['callers']),
+                            'render_path': dict(stats['render_path'])} for fingerprint, stats in self._queries.items()),
+                          key=lambda stats: stats['seconds'], reverse=True)
+
+    def format_report(self, limit=20):
+        lines = [f'{"count":>7} {"total ms":>9} {"max ms":>8} {"rows":>7}  query']
+        for stats in self.get_stats()[:limit]:
+            lines.append(f'{stats["count"]:7} {stats["seconds"] * 1000:9.2f} {stats["max_seconds"] * 1000:8.2f} '
+                         f'{stats["rows"]:7}  {stats["query"][:80]}')
+            if stats['render_path']:
+                lines.append(f'{"":35}render path: {stats["render_path"]}')
+        return '\n'.join(lines)
+
+    def export(self, path=QUERY_STATS_URL):
+        with open(path, 'w', encoding='utf-8') as file:
+            json.dump(self.get_stats(), file, indent=2, ensure_ascii=False)
+
+
+class SurfaceRegistry:
+    # Weak references to every live BaseSurface (registered by its constructor), so surfaces which are not in use but
+    # are still referenced (e.g. by callbacks or subscribers) can be found. Surfaces are grouped by class and class of
+    # the parent, pixel memory is counted by initial size (resize of BaseSurface does not reallocate pixels). Numbers
+    # of live surfaces by class are counted every interval, a class is reported as leaking if its number has grown in
+    # every of the last snapshots. Unreachable cycles are only freed by the garbage collector, so a class has to grow
+    # for a while to be reported
+
+    def __init__(self, interval=LEAK_CHECK_INTERVAL, snapshots=LEAK_CHECK_SNAPSHOTS):
+        self._surfaces = weakref.WeakSet()
+        self._lock = threading.Lock()  # register() may be called by any thread
+        self._interval = interval
+        self._snapshots = deque(maxlen=snapshots + 1)  # {class: number} of the last counts
+        self._next_check = time.monotonic() + interval
+        self._reported = set()  # leaking classes which have been reported already
+
+    def register(self, surface):
+        with self._lock:
+            self._surfaces.add(surface)
+
+    def _get_surfaces(self):
+        with self._lock:
+            return list(self._surfaces)
+
+    def get_stats(self):
+        """
+        :returns: :class:`list[dict]` - number and pixel memory of live surfaces by class and class of the parent, the
+            largest first
+        """
+
+        groups = {}
+        for surface in self._get_surfaces():
+            key = (type(surface).__name__, type(surface.parent).__name__ if surface.parent is not None else None)
+            group = groups.setdefault(key, {'class': key[0], 'parent': key[1], 'count': 0, 'bytes': 0})
+            group['count'] += 1
+            group['bytes'] += surface.get_pitch() * surface.get_height()
+        return sorted(groups.values(), key=lambda group: group['bytes'], reverse=True)
+
+    def get_leaks(self):
+        """
+        :returns: :class:`dict` - numbers of live surfaces of leaking classes in the last snapshots (oldest first)
+        """
+
+        if len(self._snapshots) < self._snapshots.maxlen:
+            return {}
+
+        leaks = {}
+        for cls in self._snapshots[-1]:
+            counts = [snapshot.get(cls, 0) for snapshot in self._snapshots]
+            if all(previous < current for previous, current in zip(counts, counts[1:])):
+                leaks[cls] = counts
+        return leaks
+
+    def update(self):
+        # called every frame by Main, counts live surfaces once an interval and warns about new leaking classes
+        # (ResourceWarning is shown with "-W default" or in development mode), the report is printed to stderr on F7
+        # (see Main)
+        if time.monotonic() < self._next_check:
+            return
+        self._next_check = time.monotonic() + self._interval
+
+        snapshot = {}
+        for surface in self._get_surfaces():
+            snapshot[type(surface).__name__] = snapshot.get(type(surface).__name__, 0) + 1
+        self._snapshots.append(snapshot)
+
+        for cls, counts in self.get_leaks().items():
+            if cls not in self._reported:
+                self._reported.add(cls)
+                warnings.warn(f'Possible leak of {cls}: live surfaces {" -> ".join(map(str, counts))}',
+                              ResourceWarning, stacklevel=2)
+
+    def format_report(self, limit=20):
+        stats = self.get_stats()
+        lines = [f'{len(self._surfaces)} live surfaces, {sum(group["bytes"] for group in stats) / 1024 ** 2:.1f} MB',
+                 f'{"count":>7} {"MB":>8}  class (parent)']
+        lines.extend(f'{group["count"]:7} {group["bytes"] / 1024 ** 2:8.2f}  {group["class"]} ({group["parent"]})'
+                     for group in stats[:limit])
+        lines.extend(f'leaking: {cls} {counts}' for cls, counts in self.get_leaks().items())
+        return '\n'.join(lines)
+
+    def export(self, path=SURFACES_REPORT_URL):
+        with open(path, 'w', encoding='utf-8') as file:
+            json.dump({'surfaces': self.get_stats(), 'leaks': self.get_leaks()}, file, indent=2)
+
+
+frame_timer = FrameTimer()
+latency = LatencyMeter()
+allocations = SurfaceAllocations()
+profile_capture = ProfileCapture()
+query_stats = QueryStats()
+surface_registry = SurfaceRegistry()
+timed = frame_timer.timed
+
+
+def timed_methods(name):
+    """
+    class decorator measuring every public method (not class or static one) as a part of the subsystem, see timed()
+    """
+
+    def decorator(cls):
+        for attr, value in tuple(vars(cls).items()):
+            if not attr.startswith('_') and inspect.isfunction(value):
+                setattr(cls, attr, timed(name)(value))
+        return cls
+
+    return decorator
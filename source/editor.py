@@ -2,13 +2,15 @@ __all__ = (
     'Editor',
 )
 
+from collections import deque
+
 import pygame
 
-from constants import SCREEN_WIDTH, SCREEN_HEIGHT, UserEvents, Media
-from game import Field
+from constants import SCREEN_WIDTH, SCREEN_HEIGHT, Messages, Media
+from game import Field, Coordinates
 from level import Level
 from templates import Button, BaseWindow, LowerPanel, StyledForm, Freezer, NotificationsPanel
-from utils import load_media, post_event, catch_events, get_tiles, DataBase
+from utils import load_media, bus, dispatcher, get_tiles, DataBase, media_packs
 
 
 class FormLevelInfo(StyledForm, Freezer):
@@ -43,17 +45,17 @@ class TilesPanel(LowerPanel):
 
     def __init__(self, uid, minimized_rect, maximized_rect, resize_time, parent=None):
         super().__init__(minimized_rect, maximized_rect, resize_time, parent=parent)
-        self._uid = uid
+        # tiles are unlocked by completion of levels, which cannot happen while the editor is opened. Buttons of tiles
+        # are rebuilt every frame by draw(), so the database is not queried there
+        self._unlocked_tiles = DataBase().get_unlocked_tiles(uid)
 
         buttons_not_hovered_view = {'scale_x': 1, 'scale_y': 1, 'border_radius': 24}
         buttons_hovered_view = {'scale_x': 1.05, 'scale_y': 1.05, 'border_radius': 21}
         buttons_data = (
             (Media.RUN, (self.parent.run_level_from_data,)),
-            (Media.CLEAR, (lambda: setattr(self.parent, '_buttoned_cells', list()),)),
+            (Media.CLEAR, (self.parent.clear_field,)),
             (Media.SAVE, (lambda: self.parent.request_level_info(),)),
-            # actually bad practice to use setattr for parent's private attributes, but cannot use events everywhere,
-            # because pygame has limitations on user events number: maximum 9 (with ids from 24 to 32)
-            (Media.CLOSE_WINDOW, (lambda: post_event(UserEvents.CLOSE_CWW),))
+            (Media.CLOSE_WINDOW, (lambda: bus.post(Messages.CLOSE_CWW),))
         )
 
         for image_name, callbacks in buttons_data:
@@ -76,13 +78,18 @@ class TilesPanel(LowerPanel):
             btn = Button(x, y, *block.get_size(), parent=self)
             btn.set_hovered_view(block, scale_x=1.1, scale_y=1.1)
             btn.set_not_hovered_view(block)
-            btn.bind_press((lambda p, b: lambda: [b_.remove_hover() for b_ in self._buttons_change_pack if b_.hovered]
-                            and b.emit_hover(True) or self.parent.set_pack(p))(k, btn))
+            btn.bind_press((lambda p: lambda: self.parent.change_pack(p))(k))
             if t == self.parent.current_pack:
                 btn.emit_hover(True)
             self._buttons_change_pack.append(btn)
             x += 35
 
+    def show_pack(self, idx):
+        # the button of the pack stays highlighted
+        for btn in self._buttons_change_pack:
+            btn.remove_hover()
+        self._buttons_change_pack[idx].emit_hover(True)
+
     @property
     def captured_tile(self):
         if self._captured_tile_index is not None:
@@ -90,10 +97,8 @@ class TilesPanel(LowerPanel):
 
     def _get_available_tiles(self):
         self._available_tiles.clear()
-        tls = DataBase().get_unlocked_tiles(self._uid)
-
         x, y = 10 + SCREEN_WIDTH // 5, 35
-        for tile in tls.values():
+        for tile in self._unlocked_tiles.values():
             img = pygame.transform.scale(load_media(tile.IMAGE_NAME.format(self.parent.current_pack)), (100, 100))
             btn = Button(x, y, 48, 48, parent=self)
             btn.set_not_hovered_view(img)
@@ -127,7 +132,48 @@ class TilesPanel(LowerPanel):
             self.blit(btn)
 
 
+class Journal:
+    # History of changes of the field as deltas: ("place", position, tile), ("remove", position, tile),
+    # ("rotate", tile, angle before, angle after), ("clear", tiles before) and ("pack", pack before, pack after).
+    # The journal only keeps changes, the editor applies them (see Editor._apply_change()), so undo() and redo() cost
+    # O(1) besides the change itself. The oldest changes are forgotten once there are more than size of them.
+    # version is changed by every change, so the field is redrawn only when it has been changed
+
+    def __init__(self, size):
+        self._undo = deque(maxlen=size)
+        self._redo = []
+        self.version = 0
+
+    def record(self, change):
+        self._undo.append(change)
+        self._redo = []  # redoing is not possible after a new change
+        self.version += 1
+
+    def undo(self):
+        """
+        :returns: :class:`tuple` - change to be reverted, None if there is nothing to undo
+        """
+
+        if not self._undo:
+            return
+        self._redo.append(change := self._undo.pop())
+        self.version += 1
+        return change
+
+    def redo(self):
+        """
+        :returns: :class:`tuple` - change to be applied again, None if there is nothing to redo
+        """
+
+        if not self._redo:
+            return
+        self._undo.append(change := self._redo.pop())
+        self.version += 1
+        return change
+
+
 class Editor(BaseWindow):
+    HISTORY_SIZE = 200  # changes which can be undone
 
     def __init__(self, uid):
         super().__init__()
@@ -139,6 +185,7 @@ class Editor(BaseWindow):
             3: Media.PURPLE_PACK
         }
         self.current_pack = self.packs[0]
+        self._requested_pack = None  # index of the pack which is applied once it is loaded
         self._bg = ...
 
         self._tiles_panel = TilesPanel(
@@ -161,10 +208,14 @@ class Editor(BaseWindow):
         self._field.rows, self._field.cols = 10, 20
         self._field.grid = (255, 255, 255)
 
-        self._buttoned_cells = []
-        self._field_updater = self._get_field_updater()
+        self._buttoned_cells = {}  # (row, col): button of the tile
+        self._journal = Journal(self.HISTORY_SIZE)
+        self._drawn_version = None  # version of the journal the field has been drawn at, see _draw_field()
 
-        self.set_pack(0)
+        self.set_pack(0, block=True)
+
+        dispatcher.listen(pygame.KEYDOWN, self._on_key_down)
+        dispatcher.listen(pygame.MOUSEBUTTONDOWN, self._on_mouse_button_down, hit_tested=False)
 
     def _check_min_usages(self):
         tfd = tuple(t_[1] for t_ in self.to_field_data())
@@ -184,118 +235,159 @@ class Editor(BaseWindow):
         if self._check_min_usages():
             Level.from_data(self.to_field_data(), self.current_pack)
 
+    def clear_field(self):
+        if self._buttoned_cells:
+            self._journal.record(('clear', self._buttoned_cells))
+            self._buttoned_cells = {}
+
     def request_level_info(self):
         if self._check_min_usages():
             w, h = SCREEN_WIDTH // 6, SCREEN_HEIGHT / 2.5
             FormLevelInfo(SCREEN_WIDTH // 2 - w // 2, SCREEN_HEIGHT // 2 - h // 2, w, h, parent=self)
 
-    def set_pack(self, idx):
+    def set_pack(self, idx, block=False):
+        # the pack is loaded in the background, the current one is shown until then (see handle())
+        self._requested_pack = idx
+        if media_packs.load(self.packs[idx], block=block):
+            self._apply_pack(idx)
+
+    def change_pack(self, idx):
+        # as set_pack(), but the change is recorded by the journal
+        current = self._requested_pack if self._requested_pack is not None else tuple(
+            self.packs.values()).index(self.current_pack)
+        if idx != current:
+            self._journal.record(('pack', current, idx))
+        self._tiles_panel.show_pack(idx)
+        self.set_pack(idx)
+
+    def _apply_pack(self, idx):
+        self._requested_pack = None
         self.current_pack = self.packs[idx]
         self._bg = pygame.transform.scale(load_media(Media.BACKGROUND.format(self.current_pack), keep_alpha=False),
                                           self._field.get_rect().size)
-        for cl in self._buttoned_cells:
+        for cl in self._buttoned_cells.values():
             cl.instance.set_pack(self.current_pack)
             cl.set_hovered_view(cl.instance.image)
             cl.set_not_hovered_view(cl.instance.image)
-            cl.draw()
-            self._field.blit(cl)
+        self._drawn_version = None  # tiles are redrawn with images of the pack
+
+    def _rotate(self, tile):
+        self._journal.record(('rotate', tile, tile.angle, (tile.angle - 90) % 360))
+        tile.angle = (tile.angle - 90) % 360
+
+    def _apply_change(self, change, revert):
+        operation, *args = change
+        if operation in ('place', 'remove'):
+            position, tile = args
+            if (operation == 'place') == revert:
+                del self._buttoned_cells[position]
+            else:
+                self._buttoned_cells[position] = tile
+        elif operation == 'rotate':
+            tile, before, after = args
+            tile.angle = before if revert else after
+        elif operation == 'clear':
+            self._buttoned_cells = args[0] if revert else {}
+        elif operation == 'pack':
+            idx = args[0] if revert else args[1]
+            self._tiles_panel.show_pack(idx)
+            self.set_pack(idx)
+
+    def undo(self):
+        if (change := self._journal.undo()) is not None:
+            self._apply_change(change, revert=True)
+
+    def redo(self):
+        if (change := self._journal.redo()) is not None:
+            self._apply_change(change, revert=False)
 
     def save_level(self, name):
         data = tuple((f'{pos.row} {pos.col}', factory.__name__, angle) for pos, factory, angle in self.to_field_data())
-        post_event(UserEvents.SAVE_LEVEL, name=name, fdata=data, pack=self.current_pack)
+        bus.publish(Messages.SAVE_LEVEL, name, data, self.current_pack, self._on_save_failed)
         self._notifications_panel.add_notification('Уровень сохранен', load_media(Media.SUCCESS),
                                                    text=f'Название: {name}', duration=3)
 
-    def to_field_data(self):
-        data = []
+    def _on_save_failed(self, _error):
+        self._notifications_panel.add_notification('Ошибка сохранения', load_media(Media.FAILED),
+                                                   text='Уровень не сохранен', duration=3)
 
-        for bc in self._buttoned_cells:
-            data.append(
-                (self._field.get_position_by_mouse_pos(bc.get_absolute_rect().center),
-                 bc.factory,
-                 bc.angle)
-            )
+    def to_field_data(self):
+        return [(Coordinates(*position), bc.factory, bc.angle) for position, bc in self._buttoned_cells.items()]
 
-        return data
-
-    def eventloop(self):
-        for event in catch_events(False):
-            # LMB pressed and colliding field and not colliding tiles panel and any tile captured
-            if event.type != pygame.MOUSEBUTTONDOWN or event.button != 1:
-                continue
-            if not self._field.is_colliding_field(pygame.mouse.get_pos(), border=False):
-                continue
-            if self._tiles_panel.get_rect().collidepoint(*pygame.mouse.get_pos()):
-                continue
-            for r in self._buttoned_cells:
-                # if there is any tile on position of the new tile, old one will be removed
-                if r.get_rect().collidepoint(pygame.mouse.get_pos()):
-                    self._buttoned_cells.remove(r)
-                    return
-            if not self._tiles_panel.captured_tile:
-                continue
-            if self._tiles_panel.captured_tile.USAGE_LIMIT is not None:
-                # times tile has been used on the field + 1 (current tile, if it will pass checks)
-                n = len(tuple(t.factory for t in self._buttoned_cells
-                              if t.factory == self._tiles_panel.captured_tile)) + 1
-                if n > self._tiles_panel.captured_tile.USAGE_LIMIT:
-                    continue
-
-            # init real cell
-            cell = self._tiles_panel.captured_tile(
-                self._field, self._field.get_position_by_mouse_pos(pygame.mouse.get_pos())
-            )
-            cell.set_pack(self.current_pack)
-            # make a copy of a real tile converting it into a button, so we can easily detect RMB press
-            fake_tile = Button(*cell.get_rect(), parent=cell.parent)
-            # setting view of a button (same in both hovered and not hovered)
-            fake_tile.set_hovered_view(cell.image)
-            fake_tile.set_not_hovered_view(cell.image)
-            # save the factory in the .tile attribute to access it on field save
-            fake_tile.factory = self._tiles_panel.captured_tile
-            fake_tile.instance = cell
-            fake_tile.angle = 0
-            fake_tile.bind_press(lambda: setattr(fake_tile, 'angle', (fake_tile.angle - 90) % 360), button='R')
-            self._buttoned_cells.append(fake_tile)
-
-    def _get_field_updater(self):
+    def _on_key_down(self, event):  # Ctrl+Z undoes, Ctrl+Y or Ctrl+Shift+Z redoes
+        if not event.mod & pygame.KMOD_CTRL:
+            return
+        if event.key == pygame.K_y or event.key == pygame.K_z and event.mod & pygame.KMOD_SHIFT:
+            self.redo()
+        elif event.key == pygame.K_z:
+            self.undo()
+
+    def _on_mouse_button_down(self, event):
+        # LMB pressed and colliding field and not colliding tiles panel and any tile captured
+        if event.button != 1:
+            return
+        if not self._field.is_colliding_field(pygame.mouse.get_pos(), border=False):
+            return
+        if self._tiles_panel.get_rect().collidepoint(*pygame.mouse.get_pos()):
+            return
+        # if there is any tile on position of the new tile, old one will be removed
+        position = tuple(self._field.get_position_by_mouse_pos(pygame.mouse.get_pos()))
+        if (r := self._buttoned_cells.pop(position, None)) is not None:
+            self._journal.record(('remove', position, r))
+            return
+        if not self._tiles_panel.captured_tile:
+            return
+        if self._tiles_panel.captured_tile.USAGE_LIMIT is not None:
+            # times tile has been used on the field + 1 (current tile, if it will pass checks)
+            n = len(tuple(t.factory for t in self._buttoned_cells.values()
+                          if t.factory == self._tiles_panel.captured_tile)) + 1
+            if n > self._tiles_panel.captured_tile.USAGE_LIMIT:
+                return
+
+        # init real cell
+        cell = self._tiles_panel.captured_tile(self._field, position)
+        cell.set_pack(self.current_pack)
+        # make a copy of a real tile converting it into a button, so we can easily detect RMB press
+        fake_tile = Button(*cell.get_rect(), parent=cell.parent)
+        # setting view of a button (same in both hovered and not hovered)
+        fake_tile.set_hovered_view(cell.image)
+        fake_tile.set_not_hovered_view(cell.image)
+        # save the factory in the .tile attribute to access it on field save
+        fake_tile.factory = self._tiles_panel.captured_tile
+        fake_tile.instance = cell
+        fake_tile.angle = 0
+        fake_tile.bind_press(lambda: self._rotate(fake_tile), button='R')
+        self._buttoned_cells[position] = fake_tile
+        self._journal.record(('place', position, fake_tile))
+
+    def _draw_field(self):
         # Since no actions happen on the field in the editor mode, there is no need to draw it every frame,
-        # and we can only update it on addition/deletion of a new fake tile
-
-        self._field.handle()  # draw grid
-        previous_buttoned_cells = self._buttoned_cells.copy()
-
-        def _compare():
-            if len(previous_buttoned_cells) != len(self._buttoned_cells):
-                return False
-            for prev, cur in zip(previous_buttoned_cells, self._buttoned_cells):
-                if prev != cur or prev.angle != cur.angle:
-                    return False
-            return True
-
-        def _updater():
-            nonlocal previous_buttoned_cells
-
-            if _compare():  # skip drawing if there is no changes
-                self._field.handle()
-                for ft in self._buttoned_cells:
-                    ft.draw()
-                    rotated = pygame.transform.rotate(ft, ft.angle)
-                    self._field.blit(rotated, ft.get_rect())
+        # and we can only update it when the journal has recorded (or undone) a change
+        if self._drawn_version != self._journal.version:
+            self._field.handle()
+            for ft in self._buttoned_cells.values():
+                ft.draw()
+                rotated = pygame.transform.rotate(ft, ft.angle)
+                self._field.blit(rotated, ft.get_rect())
+            self._drawn_version = self._journal.version
 
-            previous_buttoned_cells = self._buttoned_cells.copy()
+        for ft in tuple(self._buttoned_cells.values()):  # force events handling even if field is not updated
+            ft.handled_frame = dispatcher.frame
+            ft.eventloop()
 
-            for ft in self._buttoned_cells:  # force events handling even if field is not updated
-                ft.eventloop()
+        self.blit(self._field)
 
-            self.blit(self._field)
+    def handle(self):
+        media_packs.touch(self.current_pack)
+        if self._requested_pack is not None and media_packs.load(self.packs[self._requested_pack]):
+            self._apply_pack(self._requested_pack)
 
-        return _updater
+        super().handle()
 
     def draw(self):
         self.blit(self._bg)
 
-        self._field_updater()
+        self._draw_field()
 
         self._tiles_panel.handle()
         self.blit(self._tiles_panel)
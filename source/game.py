@@ -4,12 +4,12 @@ __all__ = (
     'Coordinates'
 )
 
-from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass
 
 import pygame
 
-from utils import load_media
+from diagnostics import timed
+from utils import load_media, dispatcher
 from templates import BaseSurface
 
 
@@ -192,10 +192,12 @@ class Field(BaseSurface):
             pygame.draw.line(self, self.grid, (col * cw, 0), (col * cw, self.get_rect().h))
 
     def _draw_cells(self):
-        with ThreadPoolExecutor(max_workers=5) as executor:
-            for cell in self._cells:
-                executor.submit((lambda c: lambda: c.handle() or self.blit(c))(cell))
+        # cells are drawn within the frame, so they are not handed to workers (see utils.Scheduler)
+        for cell in self._cells:
+            cell.handle()
+            self.blit(cell)
 
+    @timed('field')
     def draw(self):
         self.fill((255, 255, 255, 0))
 
@@ -266,8 +268,11 @@ class Cell(pygame.sprite.Sprite, BaseSurface):
             self.blit(self._image)
 
     def handle(self):
+        # input is handled before the simulation, so its effect is drawn within the same frame
+        self.handled_frame = dispatcher.frame
+        self.eventloop()
         self.update()
-        super().handle()
+        self.draw()
 
     @property
     def image(self):
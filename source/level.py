@@ -2,17 +2,18 @@ __all__ = (
     'Level',
 )
 
-import re
+import sys
+import traceback
 from datetime import datetime
-from concurrent.futures import ThreadPoolExecutor
 
 import pygame
 
-from constants import SCREEN_HEIGHT, SCREEN_WIDTH, Media, UserEvents
+from constants import SCREEN_HEIGHT, SCREEN_WIDTH, Media, Messages
 from game import Field, Coordinates
+from precompute import level_artefacts, get_layout
 from templates import NotificationsPanel, BaseWindow, LowerPanel, Button
 from tiles import Hero
-from utils import load_media, post_event, DataBase, get_tiles, catch_events
+from utils import load_media, bus, DataBase, get_tiles, dispatcher, media_packs, scheduler
 
 
 class StartPanel(LowerPanel):
@@ -26,7 +27,7 @@ class StartPanel(LowerPanel):
         buttons_hovered_view = {'scale_x': 1.05, 'scale_y': 1.05, 'border_radius': 21}
         buttons_data = [
             (Media.CLEAR, (self.parent.restart,)),
-            (Media.CLOSE_WINDOW, (lambda: post_event(UserEvents.CLOSE_CWW),))
+            (Media.CLOSE_WINDOW, (lambda: bus.post(Messages.CLOSE_CWW),))
         ]
         if is_author:
             buttons_data.append((Media.TRASH_BIN, (self.parent.remove,)))
@@ -42,6 +43,7 @@ class StartPanel(LowerPanel):
 
 
 class Level(BaseWindow):
+    LEADERBOARD_SIZE = 5
 
     def __init__(self, level_id, uid, *, _d=None, _p=None):
         super().__init__()
@@ -77,22 +79,26 @@ class Level(BaseWindow):
             parent=self
         )
 
-        self._pack = ...
+        self._pack = self._level_info[3] if _p is None else _p
 
         self._field = Field(0, 0, SCREEN_WIDTH, SCREEN_HEIGHT // 18 * 17, parent=self)
         self._field.rows, self._field.cols = 10, 20
-        self._setup_field(DataBase().get_level_field_data(level_id) if _d is None else _d,
-                          self._level_info[3] if _p is None else _p)
+        self._bg = None
+        self._preview = None  # thumbnail of the level, shown until the level is built
 
         self._best_time = DataBase().get_best_time(level_id, uid)
         self._start_time = None
 
-        self._bg = pygame.transform.scale(
-            load_media(Media.BACKGROUND.format(self._level_info[3] if _p is None else _p)), self._field.get_rect().size
-        )
+        self._leaderboard = None  # future of (top, rank, total) being loaded, see _load_leaderboard()
+        self._leaderboard_data = ([], None, 0)
+        self._request_leaderboard()
 
         self._wait_until_invoked = False
-        self.restart()
+        # the level is built by a task of the scheduler, so opening the level does not stall a frame
+        self._setup = scheduler.spawn(self._build(_d))
+
+        dispatcher.listen(pygame.KEYDOWN, self._on_input)
+        dispatcher.listen(pygame.MOUSEBUTTONDOWN, self._on_input, hit_tested=False)
 
     @property
     def best_time(self):
@@ -104,13 +110,43 @@ class Level(BaseWindow):
             return round((datetime.now() - self._start_time).total_seconds(), 2)
 
     def remove(self):
-        post_event(UserEvents.DELETE_LEVEL, level_id=self._level_id)
-        post_event(UserEvents.CLOSE_CWW)
+        bus.publish(Messages.DELETE_LEVEL, self._level_id, None)
+        bus.post(Messages.CLOSE_CWW)
+
+    def close(self):
+        # the level may be closed before it is built
+        self._setup.cancel()
+        if self._leaderboard is not None:
+            self._leaderboard.cancel()
+            self._leaderboard = None
+
+    def _load_layout(self):
+        return get_layout(DataBase().get_level_field_data(self._level_id))
+
+    def _load_leaderboard(self):
+        db = DataBase()
+        return db.get_leaderboard(self._level_id, self.LEADERBOARD_SIZE), *db.get_rank(self._level_id, self._uid)
+
+    def _request_leaderboard(self):
+        if self._level_info:  # levels run from the editor are not saved
+            self._leaderboard = scheduler.submit(self._load_leaderboard, then=self._on_leaderboard_loaded)
+
+    def _on_leaderboard_loaded(self, future):
+        if future is not self._leaderboard:  # requested again meanwhile
+            return
+        self._leaderboard = None
+        try:
+            self._leaderboard_data = future.result()
+        except Exception as e:  # the previous leaderboard is kept
+            traceback.print_exception(type(e), e, e.__traceback__, file=sys.stderr)
+
+    def _on_save_failed(self, _error):
+        self._notifications_panel2.add_notification('Ошибка сохранения', load_media(Media.FAILED),
+                                                    text='Результат не сохранен', duration=3)
 
     def _field_to_initial(self):
-        with ThreadPoolExecutor(max_workers=5) as executor:
-            for cl in self._field.get_cells():
-                executor.submit(cl.to_initial)
+        for cl in self._field.get_cells():
+            cl.to_initial()
 
     def restart(self):
         self._notifications_panel.add_notification('Нажмите любую кнопку', load_media(Media.CLOCK))
@@ -123,50 +159,60 @@ class Level(BaseWindow):
     def from_data(cls, data, pack):
         return cls(-1, -1, _d=data, _p=pack)
 
-    def _setup_field(self, data, pack):
+    def _build(self, data=None):
+        # task of the scheduler: waits for the pack (the level cannot be shown without it), then adds a cell per slice.
+        # Saved levels are built from their artefacts (see precompute.py), so their tiles are read only when the
+        # artefact has not been computed yet, the thumbnail of the artefact is shown meanwhile
+        if data is not None:  # run from the editor
+            layout = get_layout(data)
+        elif (artefact := (yield scheduler.submit(level_artefacts.load, self._level_id))) is not None:
+            layout = artefact.layout
+            self._preview = pygame.transform.scale(artefact.thumbnail.convert(), self._field.get_rect().size)
+            yield
+        else:
+            layout = yield scheduler.submit(self._load_layout)
+            level_artefacts.request(self._level_id, layout, self._pack)
+        while not media_packs.load(self._pack):
+            yield
         tls = get_tiles()
+        for row, col, tile, angle in layout:
+            self._add_cell(tls[tile], Coordinates(row, col), angle)
+            yield
 
-        for coordinates, factory, angle in data:
-            if isinstance(coordinates, str):
-                # finds groups of digits (at least one digit in group) and throws them into Coordinates instance
-                coordinates = Coordinates(
-                    *map(lambda match: int(match.group(0)), re.finditer(re.compile(r'\d+'), coordinates))
-                )
-            if isinstance(factory, str):
-                factory = tls[factory]
-            cell = factory(self._field, coordinates)
-            cell.set_pack(pack)
-            if isinstance(cell, Hero):
-                cw, ch = self._field.calc_cell_size()
-
-                s = cell.get_rect().copy()
-                o = s.copy()
-                if angle == 180:
-                    o.top -= ch
-                    cell.top_collide(s, o)
-                elif angle == 90:
-                    o.right += cw
-                    cell.right_collide(s, o)
-                elif angle == 0:
-                    o.bottom += ch
-                    cell.bottom_collide(s, o)
-                elif angle == 270:
-                    o.left -= cw
-                    cell.left_collide(s, o)
-            else:
-                cell.rotate(angle)
-            self._field.add_cells(cell)
-
-        self._pack = pack
-
-    def eventloop(self):
-        for event in catch_events(False):
-            if event.type == pygame.KEYDOWN or event.type == pygame.MOUSEBUTTONDOWN:
-                if self._wait_until_invoked:
-                    self._start_time = datetime.now()
-                self._wait_until_invoked = False
-                # clearing queue of notifications panel since multiple waiter notifications might be added
-                self._notifications_panel.clear()
+        self._bg = pygame.transform.scale(load_media(Media.BACKGROUND.format(self._pack)), self._field.get_rect().size)
+        self._preview = None
+        self.restart()
+
+    def _add_cell(self, factory, coordinates, angle):
+        cell = factory(self._field, coordinates)
+        cell.set_pack(self._pack)
+        if isinstance(cell, Hero):
+            cw, ch = self._field.calc_cell_size()
+
+            s = cell.get_rect().copy()
+            o = s.copy()
+            if angle == 180:
+                o.top -= ch
+                cell.top_collide(s, o)
+            elif angle == 90:
+                o.right += cw
+                cell.right_collide(s, o)
+            elif angle == 0:
+                o.bottom += ch
+                cell.bottom_collide(s, o)
+            elif angle == 270:
+                o.left -= cw
+                cell.left_collide(s, o)
+        else:
+            cell.rotate(angle)
+        self._field.add_cells(cell)
+
+    def _on_input(self, _event):
+        if self._wait_until_invoked:
+            self._start_time = datetime.now()
+        self._wait_until_invoked = False
+        # clearing queue of notifications panel since multiple waiter notifications might be added
+        self._notifications_panel.clear()
 
     def draw(self):
         self.blit(self._bg)
@@ -176,8 +222,11 @@ class Level(BaseWindow):
         if not self._start_panel.is_minimized():
             font = pygame.font.SysFont('arial', 16, bold=True)
 
+            top, rank, total = self._leaderboard_data
+
             texts = [f'Ваше лучшее время: {self.best_time if self.best_time else "-"}']
             if self._level_info:
+                texts.append(f'Ваше место: {f"{rank} из {total}" if rank else "-"}')
                 texts.insert(0, f'Название уровня: {self._level_info[1]}')
             if self._author_info:
                 texts.insert(0, f'Создатель уровня: {self._author_info[1]}')
@@ -189,7 +238,7 @@ class Level(BaseWindow):
 
             y = 25
             for t in texts:
-                t1, t2 = t.split(': ')
+                t1, t2 = t.split(': ', 1)
                 rendered1 = font.render(t1 + ': ', True, (143, 143, 143))
                 rendered2 = font.render(t2, True, (194, 194, 194))
                 text_surface = pygame.Surface((rendered1.get_width() + rendered2.get_width(), font.get_height()),
@@ -199,6 +248,16 @@ class Level(BaseWindow):
                 self._start_panel.blit(text_surface, (self._start_panel.get_rect().w - text_surface.get_width() - 15,
                                                       y, *text_surface.get_size()))
                 y += text_surface.get_height() + 5
+
+            # leaderboard is the column to the left of the info above
+            y = 25
+            for idx, (login, time) in enumerate(top):
+                rendered1 = font.render(f'{idx + 1}. {login}: ', True, (143, 143, 143))
+                rendered2 = font.render(str(time), True, (194, 194, 194))
+                self._start_panel.blit(rendered1, (self._start_panel.get_rect().w // 2, y, *rendered1.get_size()))
+                self._start_panel.blit(rendered2, (self._start_panel.get_rect().w // 2 + rendered1.get_width(), y,
+                                                   *rendered2.get_size()))
+                y += font.get_height() + 5
         self.blit(self._start_panel)
         self._notifications_panel.handle()
         if not self._notifications_panel.is_minimized():
@@ -208,6 +267,12 @@ class Level(BaseWindow):
             self.blit(self._notifications_panel2)
 
     def handle(self):
+        media_packs.touch(self._pack)
+        if not self._setup.done:
+            if self._preview is not None:
+                self.blit(self._preview)
+            return
+
         if not self._wait_until_invoked:
             self._field.handle()
             if self._notifications_panel.is_maximized():
@@ -219,20 +284,21 @@ class Level(BaseWindow):
         if hero.finished:
             if self._level_info and self._level_info[2] == 0:
                 for tl in DataBase().get_new_tiles(self._uid, self._level_id).values():
-                    pk = (load_media(tl.IMAGE_NAME.format(pack)) for pack in (Media.LAVA_PACK, Media.ROCK_PACK,
-                                                                              Media.SKY_PACK, Media.ROCK_PACK))
                     self._notifications_panel2.add_notification('Открыт новый блок',
-                                                                *pk,
+                                                                load_media(tl.IMAGE_NAME.format(self._pack)),
                                                                 text='Доступен в редакторе',
                                                                 duration=3)
             if not self._best_time or self.current_time < self._best_time:
                 self._best_time = self.current_time
                 if self._uid != -1:
-                    DataBase().save_completion(self._level_id, self._uid, self.current_time)
-                    post_event(UserEvents.LEVEL_COMPLETED, level_id=self._level_id, time=self.current_time)
+                    DataBase().save_completion(self._level_id, self._uid, self.current_time,
+                                               on_error=self._on_save_failed)
+                    self._request_leaderboard()
+                    bus.publish(Messages.LEVEL_COMPLETED, self._level_id, self.current_time)
 
         if hero.dead or hero.finished:
             self.restart()
 
-        self.eventloop()
+        # input is received only while the level is played (not while it is being built)
+        self.handled_frame = dispatcher.frame
         self.draw()
@@ -2,24 +2,56 @@ __all__ = (
     'Levels',
 )
 
+import sys
+import traceback
+from datetime import datetime, timedelta
+
 import pygame
 
-from constants import Media, SCREEN_HEIGHT, SCREEN_WIDTH, UserEvents
+from constants import Media, SCREEN_HEIGHT, SCREEN_WIDTH, Messages
 from level import Level
-from templates import BaseWindow, Button, Freezer, BaseSurface
-from utils import load_media, post_event, DataBase, catch_events
+from templates import BaseWindow, Button, Freezer, BaseSurface, LineEdit
+from utils import load_media, bus, DataBase, scheduler
 
 
 class UserLevelsSurface(BaseSurface, Freezer):
+    ITEMS_ON_PAGE = 15
+    SEARCH_DELAY = timedelta(milliseconds=300)  # search starts when the text has not been changed for this time
 
     def __init__(self, x, y, w, h, parent=None):
         super().__init__(x, y, w, h, parent=parent)
         self.freeze()
 
-        self._total_pages = DataBase().get_pages_num(items_on_page=15)
+        self._total_pages = DataBase().get_pages_num(items_on_page=self.ITEMS_ON_PAGE)
         self._current_page = 1
 
         self._buttons = []
+        self._first_id, self._last_id = None, None  # keys of the current page, see DataBase.load_page()
+        # page number: future of (rows, total pages), only neighbours of the current are kept. Rows are fetched by a
+        # worker, buttons of rows are built on the main thread once fetched (see _on_fetched()), since neither fonts nor
+        # surfaces are thread-safe
+        self._pages = {}
+        self._built = {}  # page number: (rows, buttons, total pages)
+        self._requested_page = None
+
+        self._query = ''  # text of the current search, all levels are listed if empty
+        self._search_text, self._search_text_changed = '', None
+        self._search_field = LineEdit(10, 40, self.get_rect().w - 20, 28, parent=self)
+        self._search_field.placeholder_text = 'Поиск по названию или автору'
+        self._search_field.set_focused_view(
+            border_radius=8,
+            border_color=pygame.Color(85, 106, 208),
+            background_color=pygame.Color(54, 53, 53),
+            text_color=pygame.Color(209, 203, 203),
+            placeholder_color=pygame.Color(125, 125, 125),
+        )
+        self._search_field.set_unfocused_view(
+            border_radius=8,
+            border_width=0,
+            background_color=pygame.Color(38, 38, 39),
+            text_color=pygame.Color(209, 203, 203),
+            placeholder_color=pygame.Color(125, 125, 125)
+        )
 
         self._button_next_page = Button(self.get_rect().w // 2 + 10, self.get_rect().h - 60, 48, 48, parent=self)
         self._button_next_page.set_hovered_view(load_media(Media.FORWARD), background_color=(102, 121, 213),
@@ -28,7 +60,7 @@ class UserLevelsSurface(BaseSurface, Freezer):
                                                     background_color=(85, 106, 208),
                                                     border_radius=6)
         self._button_next_page.bind_press(
-            lambda: self.load_page(self._current_page + 1) if self._current_page != self._total_pages else None
+            lambda: self.load_page(self._current_page + 1) if self._current_page < self._total_pages else None
         )
 
         self._button_previous_page = Button(self.get_rect().w // 2 - 58, self.get_rect().h - 60, 48, 48, parent=self)
@@ -41,17 +73,42 @@ class UserLevelsSurface(BaseSurface, Freezer):
             lambda: self.load_page(self._current_page - 1) if self._current_page != 1 else None
         )
 
+        self._request_page(self._current_page)
         self.load_page(self._current_page)
 
-    def load_page(self, page):
-        self._buttons.clear()
-
-        self._current_page = page
-        btn_height = (self.get_rect().h - 110) / 15
-        e = enumerate(DataBase().load_page(self._current_page, items_on_page=15))
-        for idx, (level_id, level_name, author_id, author_name) in e:
-            surf = BaseSurface(10, 40 + idx * btn_height, self.get_rect().w - 20, btn_height, parent=self)
-            font = pygame.font.SysFont('arial', 15)
+    def _fetch_page(self, after=None, before=None, query='', page=1):
+        # runs on a worker of the scheduler
+        db = DataBase()
+        if query:
+            return db.search_levels(query, self.ITEMS_ON_PAGE, page=page), db.get_search_pages_num(query,
+                                                                                                  self.ITEMS_ON_PAGE)
+        return db.load_page(self.ITEMS_ON_PAGE, after=after, before=before), db.get_pages_num(self.ITEMS_ON_PAGE)
+
+    def _request_page(self, page, after=None, before=None):
+        self._pages[page] = scheduler.submit(self._fetch_page, after=after, before=before, query=self._query, page=page,
+                                             then=lambda future: self._on_fetched(page, future))
+
+    def _on_fetched(self, page, future):
+        # every row is rendered here, so page flip only swaps the buttons
+        if self._pages.get(page) is not future:  # dropped meanwhile (e.g. by a new search)
+            return
+        try:
+            rows, total = future.result()
+        except Exception as e:  # the page stays unreachable, the current one is kept
+            del self._pages[page]
+            if self._requested_page == page:
+                self._requested_page = None
+            traceback.print_exception(type(e), e, e.__traceback__, file=sys.stderr)
+            return
+
+        self._built[page] = (rows, self._build_buttons(rows), total)
+
+    def _build_buttons(self, rows):
+        buttons = []
+        btn_height = (self.get_rect().h - 145) / self.ITEMS_ON_PAGE
+        font = pygame.font.SysFont('arial', 15)
+        for idx, (level_id, level_name, author_id, author_name) in enumerate(rows):
+            surf = BaseSurface(10, 75 + idx * btn_height, self.get_rect().w - 20, btn_height, parent=self)
             n = font.render(level_name, True, (169, 169, 169))
             surf.blit(n, rect=(2, (surf.get_rect().h - n.get_height()) // 2, *n.get_size()))
             c = font.render(f'от {author_name}', True, (169, 169, 169))
@@ -61,9 +118,59 @@ class UserLevelsSurface(BaseSurface, Freezer):
             btn.set_hovered_view(surf, background_color=(73, 74, 73))
             btn.set_not_hovered_view(surf)
             btn.bind_press(self.unfreeze, (lambda lid, aid: lambda: Level(lid, aid))(level_id, author_id))
-            self._buttons.append(btn)
+            buttons.append(btn)
+
+        return buttons
+
+    def _prefetch(self):
+        # search results are ranked, so they are paged by number instead of ids
+        neighbours = {self._current_page}
+        if self._current_page < self._total_pages and self._last_id is not None:
+            neighbours.add(self._current_page + 1)
+            if self._current_page + 1 not in self._pages:
+                self._request_page(self._current_page + 1, after=self._last_id)
+        if self._current_page > 1 and self._first_id is not None:
+            neighbours.add(self._current_page - 1)
+            if self._current_page - 1 not in self._pages:
+                self._request_page(self._current_page - 1, before=self._first_id)
+        self._pages = {page: future for page, future in self._pages.items() if page in neighbours}
+        self._built = {page: built for page, built in self._built.items() if page in neighbours}
+
+    def search(self, text):
+        self._query = text.strip()
+        self._first_id, self._last_id = None, None
+        self._pages, self._built = {}, {}
+        self._request_page(1)
+        self._requested_page = 1
+
+    def _update_search(self):
+        if self._search_field.text != self._search_text:
+            self._search_text, self._search_text_changed = self._search_field.text, datetime.now()
+
+        if self._search_text_changed and datetime.now() - self._search_text_changed > self.SEARCH_DELAY:
+            self._search_text_changed = None
+            if self._search_text.strip() != self._query:
+                self.search(self._search_text)
+
+    def load_page(self, page):
+        # page is shown as soon as it is built, current one is kept until then (see _apply_requested_page())
+        if page not in self._pages:  # only neighbours are reachable, see _prefetch()
+            return
+
+        self._requested_page = page
+
+    def _apply_requested_page(self):
+        if self._requested_page not in self._built:
+            return
+
+        rows, self._buttons, self._total_pages = self._built[self._requested_page]
+        self._current_page, self._requested_page = self._requested_page, None
+        self._first_id, self._last_id = (rows[0][0], rows[-1][0]) if rows else (None, None)
+        self._prefetch()
 
     def draw(self):
+        self._update_search()
+        self._apply_requested_page()
         self.fill((54, 53, 53))
 
         pygame.draw.rect(self, (202, 202, 202), (5, 5, self.get_rect().width - 10, 30))
@@ -78,7 +185,7 @@ class UserLevelsSurface(BaseSurface, Freezer):
         pygame.draw.line(surf, (117, 119, 119), (0, surf.get_height()), (surf.get_width(), 0))
 
         btn = Button(*surf.get_rect(), parent=self)
-        btn.bind_press(lambda: post_event(UserEvents.UNFREEZE_CWW, freezer=self))
+        btn.bind_press(lambda: bus.post(Messages.UNFREEZE_CWW, self))
         btn.set_hovered_view(surf)
         btn.set_not_hovered_view(surf)
         btn.handle()
@@ -88,6 +195,8 @@ class UserLevelsSurface(BaseSurface, Freezer):
         self.blit(self._button_next_page)
         self._button_previous_page.handle()
         self.blit(self._button_previous_page)
+        self._search_field.handle()
+        self.blit(self._search_field)
 
         for b in self._buttons:
             b.handle()
@@ -118,6 +227,7 @@ class Levels(BaseWindow):
                                                           background_color=(85, 106, 208),
                                                           border_radius=10)
 
+        self._closed_windows = bus.get_count(Messages.CLOSE_CWW)
         self._buttons_per_row = 10
         self._icon_completed, self._icon_unlocked, self._icon_locked = (
             pygame.transform.scale(load_media(i), (self._but_w // 4, self._but_h // 4))
@@ -125,7 +235,7 @@ class Levels(BaseWindow):
         )
         self._setup_levels_buttons()
 
-        self.back_button.bind_press(lambda: post_event(UserEvents.CLOSE_CWW))
+        self.back_button.bind_press(lambda: bus.post(Messages.CLOSE_CWW))
         w, h = SCREEN_WIDTH // 6, SCREEN_HEIGHT / 2
         self.user_levels_list_button.bind_press(
             lambda: UserLevelsSurface(SCREEN_WIDTH // 2 - w // 2, SCREEN_HEIGHT // 2 - h // 2, w, h, parent=self)
@@ -179,7 +289,8 @@ class Levels(BaseWindow):
     def eventloop(self):
         # update info about system levels on any Level close,
         # will be also called on self close, but window will be instantly shut down after that
-        if UserEvents.CLOSE_CWW in map(lambda event: event.type, catch_events(False)):
+        if (closed_windows := bus.get_count(Messages.CLOSE_CWW)) != self._closed_windows:
+            self._closed_windows = closed_windows
             self._buttons.clear()
             self._setup_levels_buttons()
 
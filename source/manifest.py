@@ -0,0 +1,127 @@
+__all__ = (
+    'MediaManifest',
+    'MediaEntry',
+    'build_manifest'
+)
+
+import json
+import os
+import re
+from collections import namedtuple
+
+import pygame
+
+from constants import MEDIA_URL, MEDIA_MANIFEST_URL
+
+DEFAULT_FRAME_DURATION = 0.05  # seconds, for frames which names do not contain delay (e.g. "frame_00_delay-0.02s.gif")
+FRAMES_DIR_EXTENSIONS = ('.gif',)  # directories of frames are named after the split file (e.g. "fly.gif")
+
+# Manifest: {media name: {"frames": [...], "durations": [...], "size": [w, h], "alpha": bool}}, where media name is a
+# path relative to MEDIA_URL (with "/" separators) of an image or of a directory of frames (e.g. gif split into frames).
+# Single images have one frame, which is the image itself
+MediaEntry = namedtuple('MediaEntry', ('frames', 'durations', 'size', 'alpha', 'animated'))
+
+
+def _natural_key(rel):  # "hero10.png" goes after "hero9.png"
+    return tuple(int(part) if part.isdigit() else part for part in re.split(r'(\d+)', rel))
+
+
+def _get_duration(rel):
+    return float(m.group(1)) if (m := re.search(r'delay-([\d.]+)s', rel)) else DEFAULT_FRAME_DURATION
+
+
+def _is_frames_dir(rel_root):
+    # other directories (e.g. packs) only group media, they are not animated
+    return os.path.splitext(rel_root)[1].lower() in FRAMES_DIR_EXTENSIONS
+
+
+def _describe(frames, images):
+    # frames are relative paths of images (frames of the same media are expected to be the same size)
+    return {
+        'frames': [frame.replace(os.sep, '/') for frame in frames],
+        'durations': [_get_duration(frame) for frame in frames],
+        'size': list(images[frames[0]].get_size()),
+        'alpha': bool(images[frames[0]].get_flags() & pygame.SRCALPHA)
+    }
+
+
+def _scan(media_dir):
+    manifest = {}
+
+    for root, _, filenames in os.walk(media_dir):
+        rel_root = os.path.relpath(root, media_dir)
+        images = {}
+        for filename in filenames:
+            try:
+                images[os.path.normpath(os.path.join(rel_root, filename))] = pygame.image.load(
+                    os.path.join(root, filename))
+            except pygame.error:  # not an image (or not supported format)
+                continue
+
+        frames = sorted(images, key=_natural_key)
+        for rel in frames:
+            manifest[rel.replace(os.sep, '/')] = _describe([rel], images)
+        if _is_frames_dir(rel_root) and frames:
+            manifest[rel_root.replace(os.sep, '/')] = _describe(frames, images)
+
+    return manifest
+
+
+class MediaManifest:
+    # Description of every media file, so media is resolved without touching the file system. It is read from
+    # MEDIA_MANIFEST_URL, which must be rebuilt on every change of MEDIA_URL directory. If the file is missing, the
+    # directory is scanned once instead. Use MediaManifest.get() to obtain the manifest
+
+    _instance = ...
+
+    def __init__(self, manifest):
+        self._entries = {}
+
+        for name, entry in manifest.items():
+            frames = tuple(os.path.normpath(frame) for frame in entry['frames'])
+            self._entries[os.path.normpath(name)] = MediaEntry(frames, tuple(entry['durations']), tuple(entry['size']),
+                                                               entry['alpha'], os.path.normpath(name) not in frames)
+
+    @classmethod
+    def get(cls):
+        if cls._instance is Ellipsis:
+            try:
+                with open(MEDIA_MANIFEST_URL, encoding='utf-8') as file:
+                    cls._instance = cls(json.load(file))
+            except (OSError, ValueError):
+                cls._instance = cls(_scan(MEDIA_URL))
+        return cls._instance
+
+    def __contains__(self, name):
+        return os.path.normpath(name) in self._entries
+
+    def __iter__(self):
+        return iter(self._entries)
+
+    def get_entry(self, name):
+        """
+        :returns: :class:`MediaEntry` - description of the media, None if there is no such media
+        """
+
+        return self._entries.get(os.path.normpath(name))
+
+
+def build_manifest(media_dir=MEDIA_URL, path=MEDIA_MANIFEST_URL):
+    """
+    describes every image and every directory of frames of media_dir
+
+    :returns: :class:`int` - number of described media
+    """
+
+    manifest = _scan(media_dir)
+    with open(path, 'w', encoding='utf-8') as file:  # one media per line, so changes of media are easy to review
+        file.write('{\n')
+        file.write(',\n'.join(f'{json.dumps(name, ensure_ascii=False)}: {json.dumps(entry, ensure_ascii=False)}'
+                               for name, entry in sorted(manifest.items())))
+        file.write('\n}\n')
+
+    return len(manifest)
+
+
+if __name__ == '__main__':
+    print(f'{build_manifest()} media have been described in "{MEDIA_MANIFEST_URL}"')
@@ -0,0 +1,228 @@
+__all__ = (
+    'LevelArtefact',
+    'LevelArtefacts',
+    'level_artefacts',
+    'get_layout',
+    'get_content_hash',
+    'get_artefact_key',
+    'precompute_levels'
+)
+
+import glob
+import hashlib
+import json
+import multiprocessing
+import os
+import re
+import sys
+import traceback
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor, wait
+
+import pygame
+
+from bundle import MediaBundle
+from constants import LEVELS_CACHE_DIR, MEDIA_URL, THUMBNAIL_SIZE, Media
+from utils import get_tiles, DataBase
+
+ARTEFACT_VERSION = 3  # is a part of keys of artefacts, so artefacts of the previous format are recomputed
+FIELD_ROWS, FIELD_COLS = 10, 20  # of the field of levels, see level.Level
+
+# Derived data of a level, computed by build_artefact() and persisted in LEVELS_CACHE_DIR as "<key>.json" and
+# "<key>.png" (thumbnail), see get_artefact_key(). Layout is ((row, col, tile name, angle), ...) in order of positions,
+# so a level is built from it without reading its tiles, grid is FIELD_ROWS rows of FIELD_COLS tile names (None for
+# empty cells) which tells what a cell collides with, bbox is (first row, first col, last row, last col) of occupied
+# cells (None if the level is empty), thumbnail is the decoded (not converted) image of the field
+LevelArtefact = namedtuple('LevelArtefact', ('key', 'layout', 'grid', 'bbox', 'thumbnail'))
+
+
+def get_layout(data):
+    """
+    :param data: Field data as it is stored by DataBase (("row col", tile name, angle), ...) or as the editor runs it
+        ((Coordinates, tile class, angle), ...)
+    :returns: :class:`tuple` - compact layout ((row, col, tile name, angle), ...) in order of positions
+    """
+
+    layout = []
+    for coordinates, tile, angle in data:
+        row, col = map(int, re.findall(r'\d+', coordinates)) if isinstance(coordinates, str) else coordinates
+        layout.append((row, col, tile if isinstance(tile, str) else tile.__name__, angle))
+    return tuple(sorted(layout))
+
+
+def get_content_hash(layout, pack):
+    # the thumbnail depends on the pack, so the pack is a part of the content
+    return hashlib.sha1(json.dumps([pack, layout]).encode()).hexdigest()
+
+
+def get_artefact_key(level_id, content_hash):
+    # the content hash is stored with the level (see DataBase.save_content_hash()), so the artefact of a level is found
+    # without reading its tiles
+    return f'{level_id}-v{ARTEFACT_VERSION}-{content_hash}'
+
+
+def _decode(rel):
+    if (bundle := MediaBundle.get()) is not None and rel in bundle:
+        return bundle.load(rel)
+    return pygame.image.load(os.path.join(MEDIA_URL, rel))
+
+
+def _render_thumbnail(layout, background, images):
+    w, h = THUMBNAIL_SIZE
+    cw, ch = w / FIELD_COLS, h / FIELD_ROWS
+    thumbnail = pygame.transform.scale(_decode(background), THUMBNAIL_SIZE)
+
+    scaled = {}  # (tile name, angle): image, tiles of the same kind are scaled once
+    for row, col, tile, angle in layout:
+        if (tile, angle) not in scaled:
+            scaled[tile, angle] = pygame.transform.scale(pygame.transform.rotate(_decode(images[tile]), angle),
+                                                         (round(cw), round(ch)))
+        thumbnail.blit(scaled[tile, angle], (round((col - 1) * cw), round((row - 1) * ch)))
+
+    return thumbnail
+
+
+def build_artefact(cache_dir, key, layout, background, images):
+    """
+    computes derived data of the level and writes it to cache_dir. Runs in processes of LevelArtefacts, so it gets
+    everything as arguments and does not touch the display
+
+    :param background: Relative path of the background of the pack
+    :param images: Relative paths of images of tiles of the pack, {tile name: path}
+    """
+
+    grid = [[None] * FIELD_COLS for _ in range(FIELD_ROWS)]
+    for row, col, tile, _angle in layout:
+        if 0 < row <= FIELD_ROWS and 0 < col <= FIELD_COLS:
+            grid[row - 1][col - 1] = tile
+    rows, cols = [row for row, *_ in layout], [col for _, col, *_ in layout]
+    bbox = (min(rows), min(cols), max(rows), max(cols)) if layout else None
+
+    os.makedirs(cache_dir, exist_ok=True)
+    # files are replaced atomically, so a reader never gets a partially written artefact. The thumbnail is written
+    # first, since the artefact is looked up by its json
+    path = os.path.join(cache_dir, key)
+    pygame.image.save(_render_thumbnail(layout, background, images), f'{path}.tmp.png')
+    os.replace(f'{path}.tmp.png', f'{path}.png')
+    with open(f'{path}.tmp', 'w', encoding='utf-8') as file:
+        json.dump({'layout': layout, 'grid': grid, 'bbox': bbox}, file)
+    os.replace(f'{path}.tmp', f'{path}.json')
+
+    # artefacts of the previous content (or format) of the level are never read again
+    level_id = key.split('-', 1)[0]
+    for filename in glob.glob(os.path.join(glob.escape(cache_dir), f'{level_id}-*')):
+        if os.path.basename(filename).split('.', 1)[0] != key:
+            os.remove(filename)
+
+
+class LevelArtefacts:
+    # Derived data of levels (see LevelArtefact). Artefacts are computed by a pool of processes, so the game does not
+    # spend frames on them, and are persisted by ids of levels and the hash of their content (see get_artefact_key()),
+    # so a level is recomputed only when its tiles (or the pack) change. An artefact is requested when a level is saved
+    # and when a level without it is opened. Levels changed outside of the game keep their previous hash until
+    # precompute_levels() is run. Processes are spawned on the first request, since forking is not safe for a process
+    # running pygame
+
+    def __init__(self, cache_dir, workers=1):
+        self._cache_dir = cache_dir
+        self._workers = workers
+        self._executor = None
+        self._pending = {}  # key: future
+
+    def load(self, level_id):
+        """
+        reads the artefact of the current content of the level and decodes its thumbnail. Does not touch the display,
+        so it runs on a worker of the scheduler (see level.Level)
+
+        :returns: :class:`LevelArtefact` - None if the artefact has not been computed yet
+        """
+
+        if (content_hash := DataBase().get_content_hash(level_id)) is None:  # has not been requested yet
+            return
+
+        key = get_artefact_key(level_id, content_hash)
+        path = os.path.join(self._cache_dir, key)
+        try:
+            with open(f'{path}.json', encoding='utf-8') as file:
+                data = json.load(file)
+            return LevelArtefact(key, tuple(map(tuple, data['layout'])), tuple(map(tuple, data['grid'])),
+                                 data['bbox'] and tuple(data['bbox']), pygame.image.load(f'{path}.png'))
+        except (OSError, ValueError, KeyError, pygame.error):  # not computed yet (or broken), it is recomputed
+            return
+
+    def request(self, level_id, layout, pack):
+        """
+        stores the content hash of the level and computes the artefact in the background unless it exists or is being
+        computed
+
+        :param layout: Compact layout of the level (see get_layout())
+        :returns: :class:`concurrent.futures.Future` - None if there is nothing to compute
+        """
+
+        content_hash = get_content_hash(layout, pack)
+        DataBase().save_content_hash(level_id, content_hash)
+        key = get_artefact_key(level_id, content_hash)
+        if key in self._pending or os.path.exists(os.path.join(self._cache_dir, f'{key}.json')):
+            return
+
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(max_workers=self._workers,
+                                                 mp_context=multiprocessing.get_context('spawn'))
+        self._pending[key] = future = self._executor.submit(build_artefact, self._cache_dir, key, layout,
+                                                            *_get_media(pack))
+        future.add_done_callback(lambda done: self._pending.pop(key, None))
+        future.add_done_callback(_report_error)
+        return future
+
+    def close(self, wait=False):
+        # artefacts which are not computed yet are requested again on the next opening of their levels
+        if self._executor is not None:
+            self._executor.shutdown(wait=wait, cancel_futures=True)
+            self._executor = None
+
+
+def _get_media(pack):
+    return Media.BACKGROUND.format(pack), {name: tile.IMAGE_NAME.format(pack) for name, tile in get_tiles().items()}
+
+
+def _report_error(future):
+    if not future.cancelled() and (error := future.exception()) is not None:
+        traceback.print_exception(type(error), error, error.__traceback__, file=sys.stderr)
+
+
+level_artefacts = LevelArtefacts(LEVELS_CACHE_DIR)
+
+
+def precompute_levels(cache_dir=LEVELS_CACHE_DIR, workers=None):
+    """
+    computes missing artefacts of every level of the database (refreshing content hashes of levels, which may have
+    been changed outside of the game) and removes artefacts of levels which no longer exist (or have changed)
+
+    :returns: :class:`tuple[int, int]` - number of computed and of removed artefacts
+    """
+
+    db = DataBase()
+    artefacts = LevelArtefacts(cache_dir, workers=workers or os.cpu_count())
+    keys, futures = set(), []
+    for level_id, pack in db.get_levels_packs():
+        layout = get_layout(db.get_level_field_data(level_id))
+        keys.add(get_artefact_key(level_id, get_content_hash(layout, pack)))
+        if (future := artefacts.request(level_id, layout, pack)) is not None:
+            futures.append(future)
+    wait(futures)
+    artefacts.close()
+    DataBase.flush()
+
+    removed = set()
+    for filename in os.listdir(cache_dir) if os.path.isdir(cache_dir) else ():
+        if (key := filename.split('.', 1)[0]) not in keys:
+            os.remove(os.path.join(cache_dir, filename))
+            removed.add(key)
+
+    return len(futures), len(removed)
+
+
+if __name__ == '__main__':
+    computed, removed = precompute_levels()
+    print(f'{computed} artefacts of levels have been computed, {removed} stale ones have been removed from '
+          f'"{LEVELS_CACHE_DIR}"')
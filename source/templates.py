@@ -9,16 +9,75 @@ __all__ = (
     'FormField',
     'StyledForm',
     'NotificationsPanel',
-    'Freezer'
+    'ProgressScreen',
+    'ProfilerOverlay',
+    'Freezer',
+    'hit_index'
 )
 
+import weakref
+from collections import defaultdict
 from datetime import datetime, timedelta
 from queue import Queue
 
 import pygame
 
-from constants import FPS, UserEvents, SCREEN_SIZE, Media
-from utils import catch_events, post_event, load_media
+from constants import FPS, Messages, SCREEN_SIZE, Media
+from diagnostics import frame_timer, timed, allocations, surface_registry
+from utils import dispatcher, bus, load_media
+
+
+class _HitIndex:
+    # Uniform grid of absolute rects of surfaces asking whether they are under the cursor. The cursor is sampled once
+    # per frame by update(), surfaces under it are found by the only cell containing the cursor and kept until the next
+    # update. Surfaces are (re)placed into the grid lazily, when their absolute rect is changed (see BaseSurface)
+
+    CELL_SIZE = 128
+
+    def __init__(self):
+        self._cells = defaultdict(weakref.WeakSet)  # (column, row): surfaces
+        self._rects = weakref.WeakKeyDictionary()  # surface: absolute rect it is placed by
+        self._cursor = (-1, -1)
+        self._under_cursor = weakref.WeakSet()
+
+    @property
+    def cursor(self):
+        return self._cursor
+
+    def _get_cells(self, rect):
+        for col in range(rect.left // self.CELL_SIZE, (rect.right - 1) // self.CELL_SIZE + 1):
+            for row in range(rect.top // self.CELL_SIZE, (rect.bottom - 1) // self.CELL_SIZE + 1):
+                yield col, row
+
+    def update(self):
+        self._cursor = pygame.mouse.get_pos()
+        cell = (self._cursor[0] // self.CELL_SIZE, self._cursor[1] // self.CELL_SIZE)
+        self._under_cursor = weakref.WeakSet(
+            surface for surface in self._cells.get(cell, ()) if self._rects[surface].collidepoint(self._cursor)
+        )
+
+    def _place(self, surface, rect):
+        if (previous := self._rects.get(surface)) is not None:
+            for cell in self._get_cells(previous):
+                self._cells[cell].discard(surface)
+        for cell in self._get_cells(rect):
+            self._cells[cell].add(surface)
+        self._rects[surface] = rect
+
+        if rect.collidepoint(self._cursor):
+            self._under_cursor.add(surface)
+        else:
+            self._under_cursor.discard(surface)
+
+    def is_under_cursor(self, surface, rect):
+        # rect is the current absolute rect of the surface, it is compared by identity, since cached rects are replaced
+        # (not modified) on every change
+        if self._rects.get(surface) is not rect:
+            self._place(surface, rect)
+        return surface in self._under_cursor
+
+
+hit_index = _HitIndex()
 
 
 class BaseSurface(pygame.Surface):
@@ -30,16 +89,29 @@ class BaseSurface(pygame.Surface):
         # transparent surface (pygame.SRCALPHA). If surface is transformable, fill it with transparent rect (alpha=0)
         # on every update (e.g. self.fill(255, 255, 255, 0))
         super().__init__((w, h), pygame.SRCALPHA)
+        allocations.record(self)
 
         self._rect = self.get_rect(topleft=(x, y))
         self._parent = parent
         self._background = pygame.Color((0, 0, 0))
 
+        # absolute rect is cached until the surface or any of its ancestors is moved or resized
+        self._absolute_rect = None
+        self._children = weakref.WeakSet()
+        if isinstance(parent, BaseSurface):
+            parent._children.add(self)
+        surface_registry.register(self)
+
+        # the frame the surface has been handled in, events it listens to are delivered in the next one (see
+        # EventDispatcher). Surfaces which override handle() must update it as well
+        self.handled_frame = -1
+
     def handle(self):
         # this method should mainly be called to update a surface, but if you wish to ignore any of methods:
         # draw() or eventloop(), you can call them separately. classes which inherit BaseSurface recommended to override
         # draw() and/or eventloop() methods, but it's also available to override handle() if required
 
+        self.handled_frame = dispatcher.frame
         self.draw()
         self.eventloop()
 
@@ -62,19 +134,34 @@ class BaseSurface(pygame.Surface):
                 return rect
         return self._rect.copy()
 
-    def get_absolute_rect(self):
-        x, y = 0, 0
-        surface = self
+    def _get_absolute_rect(self):  # cached one, must not be modified
+        if self._absolute_rect is not None:
+            return self._absolute_rect
 
-        while hasattr(surface, 'parent') and surface.parent:
-            try:
-                addx, addy = surface.get_rect().topleft
+        x, y = 0, 0
+        if self._parent:  # position of the surface without parent is not counted
+            x, y = self._rect.topleft
+            if isinstance(self._parent, BaseSurface):
+                addx, addy = self._parent._get_absolute_rect().topleft
                 x += addx
                 y += addy
-            finally:
-                surface = surface.parent
 
-        return pygame.Rect(x, y, self._rect.w, self._rect.h)
+        self._absolute_rect = pygame.Rect(x, y, self._rect.w, self._rect.h)
+        return self._absolute_rect
+
+    def get_absolute_rect(self):
+        return self._get_absolute_rect().copy()
+
+    def _invalidate_absolute_rect(self):
+        # absolute rects of descendants are not cached either, if the one of the surface is not
+        if self._absolute_rect is None:
+            return
+        self._absolute_rect = None
+        for child in tuple(self._children):
+            child._invalidate_absolute_rect()
+
+    def is_under_cursor(self):
+        return hit_index.is_under_cursor(self, self._get_absolute_rect())
 
     def fill(self, color, rect=None, special_flags=0):
         super().fill(color, rect, special_flags)
@@ -85,21 +172,26 @@ class BaseSurface(pygame.Surface):
 
     # fake
     def move(self, x=..., y=...):
+        topleft = self._rect.topleft
         if x != Ellipsis:
             self._rect.x = x
         if y != Ellipsis:
             self._rect.y = y
+        if self._rect.topleft != topleft:
+            self._invalidate_absolute_rect()
 
     # fake
     def resize(self, w=..., h=...):  # anchors to center (new rect will have the same center)
         # This method just resizes the rect of the surface, not the surface itself.
         # Real resize happens in the blit() method, which scales a surface to its rect size
-        center = self._rect.center
+        center, rect = self._rect.center, self._rect.copy()
         if w != Ellipsis:
             self._rect.w = w
         if h != Ellipsis:
             self._rect.h = h
         self._rect.center = center
+        if self._rect != rect:
+            self._invalidate_absolute_rect()
 
     def blit(self, source, rect=..., **kwargs):
         if rect == Ellipsis:
@@ -131,7 +223,11 @@ class BaseWindow(BaseSurface):
 
     def __init__(self):
         super().__init__(0, 0, *SCREEN_SIZE)
-        post_event(UserEvents.SET_CWW, window=self)
+        bus.post(Messages.SET_CWW, self)
+
+    def close(self):
+        # called once the window is removed from the stack of windows, deferred work of the window is stopped here
+        return
 
 
 class _SupportsBorder(BaseSurface):  # border-style: solid;
@@ -201,7 +297,7 @@ class _SupportsHover(_SupportsBorder):
     def hovered(self):
         if self._hover_emit_state is not None:
             return self._hover_emit_state
-        return self.get_absolute_rect().collidepoint(*pygame.mouse.get_pos())
+        return self.is_under_cursor()
 
     def emit_hover(self, state):
         self._hover_emit_state = state
@@ -282,16 +378,23 @@ class _SupportsHover(_SupportsBorder):
 
 class Button(_SupportsHover):
 
+    MOUSE_BUTTONS = ('L', 'W', 'R')  # in order of pygame numbers of mouse buttons (starting from 1)
+
     def __init__(self, x, y, w, h, parent=None):
         super().__init__(x, y, w, h, parent=parent)
 
-        # Left, Wheel, Right. Keep this order, it's used in draw()
+        # keys are MOUSE_BUTTONS
         self._callbacks_press = {'L': (), 'W': (), 'R': ()}
         self._callbacks_hold = {'L': (), 'W': (), 'R': ()}
         self._callbacks_release = {'L': (), 'W': (), 'R': ()}
 
         self._held = []
 
+        # presses are hit-tested by dispatcher, releases are received anywhere (even if the button has been hidden by
+        # the press, so it is not kept held)
+        dispatcher.listen(pygame.MOUSEBUTTONDOWN, self._on_mouse_button)
+        dispatcher.listen(pygame.MOUSEBUTTONUP, self._on_mouse_button, handled_only=False)
+
     @staticmethod
     def _get_callbacks(collection, button):
         return collection.get(button, ())
@@ -342,16 +445,15 @@ class Button(_SupportsHover):
         for callback in callbacks:
             callback()
 
+    def _on_mouse_button(self, event):
+        if not 0 < event.button <= len(self.MOUSE_BUTTONS):
+            return
+        if event.type == pygame.MOUSEBUTTONDOWN:
+            self.emit_press(self.MOUSE_BUTTONS[event.button - 1])
+        else:
+            self.emit_release(self.MOUSE_BUTTONS[event.button - 1])
+
     def eventloop(self):
-        for event in catch_events(False):
-            try:
-                button = tuple(self._callbacks_press.keys())[event.button - 1]
-            except (IndexError, AttributeError):
-                continue
-            if event.type == pygame.MOUSEBUTTONDOWN and self.get_absolute_rect().collidepoint(*pygame.mouse.get_pos()):
-                self.emit_press(button)
-            if event.type == pygame.MOUSEBUTTONUP:
-                self.emit_release(button)
         for hb in self._held:
             self._invoke(*self._callbacks_hold[hb])
 
@@ -392,7 +494,7 @@ class Panel(BaseSurface):
         )
 
     def _is_active(self):
-        return self.get_absolute_rect().collidepoint(*pygame.mouse.get_pos()) or self._show_till > datetime.now()
+        return self.is_under_cursor() or self._show_till > datetime.now()
 
     def eventloop(self):
         if self._is_active() and not self.is_maximized():
@@ -407,6 +509,7 @@ class Panel(BaseSurface):
         self.resize(*rect.size)
         self.move(*rect.topleft)
 
+    @timed('panels')
     def handle(self):
         super().handle()
 
@@ -511,6 +614,10 @@ class LineEdit(_SupportsBorder):
         self._pressed_keys = set()
         self._bs_next_unlock = datetime.now()
 
+        # focus is changed by presses anywhere, so they are not hit-tested
+        dispatcher.listen(pygame.MOUSEBUTTONDOWN, self._on_mouse_button_down, hit_tested=False)
+        dispatcher.listen(pygame.KEYDOWN, self._on_key_down)
+
     def get_params(self, focused, *keys):
         data = {}
         c = self._focused_data if focused else self._unfocused_data
@@ -643,11 +750,12 @@ class LineEdit(_SupportsBorder):
         if self.focused and pressed[pygame.K_RETURN]:
             self.focused = False
 
-        for event in catch_events(False):
-            if event.type == pygame.MOUSEBUTTONDOWN:
-                self._is_focused = self.get_absolute_rect().collidepoint(*pygame.mouse.get_pos())
-            if self.focused and event.type == pygame.KEYDOWN and event.unicode and event.unicode.isprintable():
-                self.text += event.unicode
+    def _on_mouse_button_down(self, event):
+        self._is_focused = self._get_absolute_rect().collidepoint(*event.pos)
+
+    def _on_key_down(self, event):
+        if self.focused and event.unicode and event.unicode.isprintable():
+            self.text += event.unicode
 
 
 class FormField(LineEdit):
@@ -739,10 +847,10 @@ class FormField(LineEdit):
 class Freezer:
 
     def freeze(self):
-        post_event(UserEvents.FREEZE_CWW, freezer=self)
+        bus.post(Messages.FREEZE_CWW, self)
 
     def unfreeze(self):
-        post_event(UserEvents.UNFREEZE_CWW, freezer=self)
+        bus.post(Messages.UNFREEZE_CWW, self)
 
 
 class Form(_SupportsBorder):
@@ -892,12 +1000,14 @@ class Form(_SupportsBorder):
             y += field.get_rect().h
 
             if field.secret:
-                secret_btn = Button(self.get_rect().w - self.contents_margin_inline - field.secret_view.get_rect().w, y,
-                                    *field.secret_view.get_size(), parent=self)
-                secret_btn.set_hovered_view(field.secret_view)
-                secret_btn.set_not_hovered_view(field.secret_view)
-                secret_btn.bind_press((lambda f: lambda: setattr(f, 'secret_state', not f.secret_state))(field))
-                field.secret_button = secret_btn
+                x = self.get_rect().w - self.contents_margin_inline - field.secret_view.get_rect().w
+                if field.secret_button is None:  # created once, since it listens to presses since the next frame
+                    secret_btn = Button(x, y, *field.secret_view.get_size(), parent=self)
+                    secret_btn.set_hovered_view(field.secret_view)
+                    secret_btn.set_not_hovered_view(field.secret_view)
+                    secret_btn.bind_press((lambda f: lambda: setattr(f, 'secret_state', not f.secret_state))(field))
+                    field.secret_button = secret_btn
+                field.secret_button.move(x, y)
 
             if field.secret_button:
                 field.secret_button.handle()
@@ -926,7 +1036,7 @@ class Form(_SupportsBorder):
 
             btn = Button(*surf.get_rect(), parent=self)
             btn.bind_press(
-                lambda: post_event(UserEvents.UNFREEZE_CWW, freezer=self if isinstance(self, Freezer) else self.parent)
+                lambda: bus.post(Messages.UNFREEZE_CWW, self if isinstance(self, Freezer) else self.parent)
             )
             btn.set_hovered_view(surf)
             btn.set_not_hovered_view(surf)
@@ -1087,3 +1197,92 @@ class NotificationsPanel(Panel):
         if self._queue.empty():
             raise StopIteration('Notifications queue is empty') from None
         return self._queue.get()
+
+
+class ProgressScreen(BaseSurface):
+    # shown while something is loaded before the first window (e.g. media preloading on startup)
+
+    def __init__(self, x, y, w, h, text='Загрузка', parent=None):
+        super().__init__(x, y, w, h, parent=parent)
+
+        self._text = text
+        self._progress = 0.0
+        self._font = pygame.font.SysFont('arial', 24)
+
+    @property
+    def progress(self):
+        return self._progress
+
+    @progress.setter
+    def progress(self, value):  # from 0 to 1
+        self._progress = min(max(value, 0.0), 1.0)
+
+    def draw(self):
+        self.fill((54, 57, 62))
+
+        bar = pygame.Rect(0, 0, self.get_rect().w // 3, 12)
+        bar.center = self.get_rect().w // 2, self.get_rect().h // 2
+        text = self._font.render(f'{self._text}... {round(self.progress * 100)}%', True, (209, 203, 203))
+        self.blit(text, rect=text.get_rect(midbottom=(bar.centerx, bar.top - 15)))
+
+        pygame.draw.rect(self, (38, 38, 39), bar, border_radius=6)
+        pygame.draw.rect(self, (85, 106, 208), (*bar.topleft, bar.w * self.progress, bar.h), border_radius=6)
+
+
+class ProfilerOverlay(BaseSurface):
+    # frame time statistics of diagnostics.frame_timer: percentiles, graph of the last frames split into phases and
+    # time spent by subsystems. Frame timer must be enabled while the overlay is shown. Surface allocations of the last
+    # frame are shown too if diagnostics.allocations is enabled
+
+    PHASES_COLORS = {
+        'input': (230, 126, 34),
+        'window': (85, 106, 208),
+        'freezers': (155, 89, 182),
+        'render': (46, 204, 113),
+        'present': (241, 196, 15),
+        'end': (231, 76, 60),
+        'idle': (127, 140, 141)
+    }
+
+    def __init__(self, x, y, w, h, parent=None):
+        super().__init__(x, y, w, h, parent=parent)
+
+        self._font = pygame.font.SysFont('consolas', 13)
+
+    def _draw_text(self, text, x, y, color=(209, 203, 203)):
+        rendered = self._font.render(text, True, color)
+        self.blit(rendered, rect=(x, y, *rendered.get_size()))
+        return y + rendered.get_height() + 2
+
+    def _draw_graph(self, rect):
+        # one column per frame, phases are stacked from the bottom. The line marks the budget of a frame (1 / FPS)
+        pygame.draw.rect(self, (38, 38, 39), rect)
+        scale = rect.h / (2 / FPS)
+
+        for idx, durations in enumerate(frame_timer.get_history()[-rect.w:]):
+            y = rect.bottom
+            for phase, duration in zip(frame_timer.PHASES, durations):
+                h = min(duration * scale, y - rect.top)
+                pygame.draw.line(self, self.PHASES_COLORS[phase], (rect.x + idx, y), (rect.x + idx, y - h))
+                y -= h
+
+        pygame.draw.line(self, (209, 203, 203), (rect.x, rect.centery), (rect.right - 1, rect.centery))
+
+    def draw(self):
+        self.fill((0, 0, 0, 190))
+
+        stats = frame_timer.get_stats()
+        p50, p95, p99, p100 = (round(p * 1000, 1) for p in frame_timer.get_percentiles(50, 95, 99, 100))
+        y = self._draw_text(f'frame, ms: p50 {p50}  p95 {p95}  p99 {p99}  max {p100}', 10, 10)
+        if allocations.enabled:
+            allocated, allocated_bytes = allocations.get_last()
+            y = self._draw_text(f'surfaces: {allocated} per frame, {allocated_bytes / 1024:.1f} KB', 10, y)
+
+        for phase in frame_timer.PHASES:
+            mean = stats[phase]['mean'] or 0
+            y = self._draw_text(f'{phase:<10}{mean * 1000:7.2f} ms', 10, y, self.PHASES_COLORS[phase])
+        for name in sorted(set(stats) - set(frame_timer.PHASES)):
+            mean = stats[name]['mean'] or 0
+            y = self._draw_text(f'{name:<10}{mean * 1000:7.2f} ms', 10, y)
+
+        self._draw_graph(pygame.Rect(10, y + 5, self.get_rect().w - 20, self.get_rect().h - y - 15))
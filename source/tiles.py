@@ -9,10 +9,12 @@ import math
 
 import pygame
 
+from animation import Animation
 from constants import Media
+from diagnostics import latency
 from game import Cell
 from templates import BaseSurface
-from utils import load_media, catch_events
+from utils import load_media, dispatcher
 
 
 class Hero(Cell):
@@ -85,10 +87,18 @@ class Hero(Cell):
 
         self._aso = None
 
+        self._hero_angle = 0
+        self._fly_animation = None
+        self._landing_animation = None  # is set on landing only
+
+        dispatcher.listen(pygame.KEYDOWN, self._on_key_down)
+
     def set_pack(self, pack):
         super().set_pack(pack)
         self._original_image = self._image.copy()
         self._arrow_vector.set_pack(pack)
+        self._fly_animation = Animation(Media.HERO_FLY.format(pack), loop=True, size=self.get_rect().size,
+                                        angle=self._hero_angle, frame_duration=0.06)
 
     @property
     def finished(self):
@@ -98,10 +108,12 @@ class Hero(Cell):
     def dead(self):
         return self._dead
 
-    def eventloop(self):
-        for e in catch_events(False):
-            if e.type == pygame.KEYDOWN and e.key == pygame.K_SPACE:
-                self._arrow_vector.flying = True
+    def _on_key_down(self, event):
+        if event.key == pygame.K_SPACE:
+            if not self._arrow_vector.flying:
+                self._fly_animation.restart()
+                latency.mark_effect()
+            self._arrow_vector.flying = True
 
     def _get_arrow_vector_rect(self):
         return pygame.Rect(
@@ -182,8 +194,12 @@ class Hero(Cell):
                         else:
                             self.bottom_collide(s, o)
 
-            for cord in (self.get_absolute_rect().topleft, self.get_absolute_rect().topright,
-                         self.get_absolute_rect().bottomleft, self.get_absolute_rect().bottomright):
+                # angle is set by collision handlers above
+                self._landing_animation = Animation(Media.HERO_LANDING.format(self.pack), size=self.get_rect().size,
+                                                    angle=self._hero_angle, frame_duration=0.04)
+
+            rect = self.get_absolute_rect()
+            for cord in (rect.topleft, rect.topright, rect.bottomleft, rect.bottomright):
                 if not self.parent.is_colliding_field(cord, border=False):
                     self._dead = True
 
@@ -234,7 +250,12 @@ class Hero(Cell):
 
     def draw(self):
         self.fill((255, 255, 255, 0))
-        super().draw()
+        if self._arrow_vector.flying:
+            self.blit(self._fly_animation.get_frame())
+        elif self._landing_animation is not None and not self._landing_animation.finished:
+            self.blit(self._landing_animation.get_frame())
+        else:
+            super().draw()
 
         self._arrow_vector.handle()
         self._field.blit(self._arrow_vector)
@@ -246,6 +267,11 @@ class Hero(Cell):
 
     def rotate(self, angle):
         self._image = pygame.transform.scale(pygame.transform.rotate(self._original_image, angle), self.get_rect().size)
+        self._hero_angle = angle
+
+        # frames are shared by every hero of the pack with the same size and angle (see animation.FrameStrip)
+        self._fly_animation = Animation(Media.HERO_FLY.format(self.pack), loop=True, size=self.get_rect().size,
+                                        angle=angle, frame_duration=0.06)
 
     def _get_collided_tiles(self):
         collided = dict()
@@ -1,45 +1,197 @@
 __all__ = (
     'load_media',
+    'load_frames',
+    'get_media_manifest',
+    'get_startup_manifest',
+    'media_cache',
+    'MediaCache',
+    'MediaPreloader',
+    'Scheduler',
+    'Task',
+    'scheduler',
+    'get_pack_manifest',
+    'media_packs',
+    'MediaPacks',
     'get_tiles',
     'DataBase',
-    'post_event',
-    'catch_events'
+    'EventDispatcher',
+    'dispatcher',
+    'MessageBus',
+    'bus'
 )
 
+import heapq
 import itertools
 import os
+import re
 import sqlite3
-from functools import cache, wraps
+import sys
+import threading
+import time
+import traceback
+import weakref
+from collections import deque, OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+from queue import Queue, Empty
 
-import bcrypt
 import pygame
 
-from constants import MEDIA_URL, DB_URL
+from bundle import MediaBundle
+from constants import (MEDIA_URL, DB_URL, BCRYPT_ROUNDS, MEDIA_CACHE_BUDGET, MEDIA_CACHE_PRESSURE, PACK_IDLE_TIMEOUT,
+                       FRAME_TASKS_BUDGET, Media)
+from diagnostics import timed_methods, query_stats
+from manifest import MediaManifest
+
+
+class MediaCache:
+    # Process-wide cache of converted media surfaces, keyed by (relative path, keep_alpha). Surfaces are shared, so they
+    # must never be modified in place (copy or transform them instead). The least recently used surfaces are evicted
+    # when resident bytes exceed the budget
+
+    def __init__(self, budget):
+        self._budget = budget
+        self._surfaces = OrderedDict()
+        self._lock = threading.Lock()
+
+        self._resident_bytes = 0
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+
+    @property
+    def budget(self):
+        return self._budget
+
+    @budget.setter
+    def budget(self, value):
+        with self._lock:
+            self._budget = value
+            self._evict()
+
+    @property
+    def resident_bytes(self):
+        return self._resident_bytes
+
+    @staticmethod
+    def _sizeof(surface):
+        return surface.get_pitch() * surface.get_height()
+
+    def get(self, key):
+        with self._lock:
+            surface = self._surfaces.get(key)
+            if surface is None:
+                self._misses += 1
+                return
+            self._hits += 1
+            self._surfaces.move_to_end(key)
+            return surface
+
+    def put(self, key, surface):
+        with self._lock:
+            if key in self._surfaces:
+                self._resident_bytes -= self._sizeof(self._surfaces.pop(key))
+            self._surfaces[key] = surface
+            self._resident_bytes += self._sizeof(surface)
+            self._evict()
+
+    def _evict(self):
+        while self._resident_bytes > self._budget and len(self._surfaces) > 1:  # the newest one is always kept
+            _, surface = self._surfaces.popitem(last=False)
+            self._resident_bytes -= self._sizeof(surface)
+            self._evictions += 1
+
+    def discard(self, predicate):
+        # removes surfaces which keys match the predicate, returns the number of removed ones
+        with self._lock:
+            keys = [key for key in self._surfaces if predicate(key)]
+            for key in keys:
+                self._resident_bytes -= self._sizeof(self._surfaces.pop(key))
+        return len(keys)
+
+    def __contains__(self, key):  # does not affect statistics and order
+        return key in self._surfaces
+
+    def __len__(self):
+        return len(self._surfaces)
+
+    def clear(self):
+        with self._lock:
+            self._surfaces.clear()
+            self._resident_bytes = 0
+
+    def get_stats(self):
+        return {
+            'hits': self._hits,
+            'misses': self._misses,
+            'evictions': self._evictions,
+            'resident_bytes': self._resident_bytes,
+            'budget': self._budget,
+            'surfaces': len(self._surfaces)
+        }
+
+
+media_cache = MediaCache(MEDIA_CACHE_BUDGET)
+
+
+# Media is resolved by the manifest (see manifest.py) without touching the file system. Pixels are served by the
+# bundle (see bundle.py) if it has been built, otherwise they are loaded from MEDIA_URL directory
+
+def _get_frames(filename):
+    # relative paths of the frames (in order), if filename is animated (e.g. gif split into frames). Otherwise, None
+    if (entry := MediaManifest.get().get_entry(filename)) is not None and entry.animated:
+        return list(entry.frames)
+
+
+def _is_dir(filename):
+    return (entry := MediaManifest.get().get_entry(filename)) is not None and entry.animated
+
+
+def _exists(filename):
+    return filename in MediaManifest.get()
+
+
+def _decode(rel):
+    # not converted surface of the file. Surfaces of the bundle share memory with it, the file is not read
+    if (bundle := MediaBundle.get()) is not None and rel in bundle:
+        return bundle.load(rel)
+    return pygame.image.load(os.path.join(MEDIA_URL, rel))
+
+
+def _convert(surface, alpha):
+    # surfaces of the bundle are stored in the display format, so they are used as they are (without copying)
+    if alpha:
+        return surface if MediaBundle.is_display_format(surface) else surface.convert_alpha()
+    return surface.convert()
+
+
+def _load_surface(rel, alpha):
+    if (cached := media_cache.get((rel, alpha))) is not None:
+        return cached
+
+    loaded = _convert(_decode(rel), alpha)
+    media_cache.put((rel, alpha), loaded)
+    return loaded
 
 
 class _MediaFramesIterator:
 
     def __init__(self, filename, repeat=False, alpha=True):
         self._alpha = alpha
-        abs_path = os.path.join(MEDIA_URL, filename)
 
-        if not os.path.isdir(abs_path):  # file (not directory)
+        if (lr := _get_frames(filename)) is None:  # file (not directory)
             self.__iterator = itertools.cycle((self._load_frame(filename),))  # repeats one frame (only existing)
             return
 
-        lr = os.listdir(abs_path)
         if repeat:
             # repeats whole sequence of the frames
-            self.__iterator = itertools.cycle((self._load_frame(os.path.join(filename, file)) for file in lr))
+            self.__iterator = itertools.cycle((self._load_frame(rel) for rel in lr))
         else:
             # iterates all frames once and then repeats last frame (as single image)
-            self.__iterator = itertools.chain((self._load_frame(os.path.join(filename, file)) for file in lr),
-                                              itertools.cycle((self._load_frame(os.path.join(filename, lr[-1])),)))
+            self.__iterator = itertools.chain((self._load_frame(rel) for rel in lr),
+                                              itertools.cycle((self._load_frame(lr[-1]),)))
 
-    @cache  # if there are memory issues, use functools.lru_cache(maxsize={max_memory_usage_integer})
     def _load_frame(self, rel):
-        loaded = pygame.image.load(os.path.join(MEDIA_URL, rel))
-        return loaded.convert_alpha() if self._alpha else loaded.convert()
+        return _load_surface(rel, self._alpha)
 
     def __iter__(self):
         return self.__iterator
@@ -51,12 +203,292 @@ class _MediaFramesIterator:
 # repeats last frame if repeat=False. Otherwise, repeats all frames
 def load_media(filename, repeat=False, keep_alpha=True):
     iterator = _MediaFramesIterator(filename, repeat=repeat, alpha=keep_alpha)
-    return iterator if os.path.isdir(os.path.join(MEDIA_URL, filename)) else next(iterator)
+    return iterator if _is_dir(filename) else next(iterator)
+
+
+def load_frames(filename, keep_alpha=True):
+    """
+    loads every frame of the directory (e.g. gif split into frames) at once
+
+    :returns: :class:`list[tuple[str, pygame.Surface]]` - relative paths of the frames and frames (shared, do not
+        modify them). Single frame is returned if filename is a file
+    """
+
+    return [(rel, _load_surface(rel, keep_alpha)) for rel in _get_frames(filename) or (filename,)]
+
+
+class Task:
+    # Cooperative task of the scheduler (see Scheduler.spawn()), it is done once its generator is exhausted
+
+    def __init__(self, generator):
+        self._generator = generator
+        self._waiting = None  # future the task is suspended on
+        self.done = False
+        self.result = None  # value returned by the generator
+
+    @property
+    def ready(self):
+        return not self.done and (self._waiting is None or self._waiting.done())
+
+    def step(self):
+        # runs one slice of the task, the result (or the exception) of the awaited future is sent into the generator
+        future, self._waiting = self._waiting, None
+        try:
+            if future is not None and future.exception() is not None:
+                yielded = self._generator.throw(future.exception())
+            else:
+                yielded = self._generator.send(future.result() if future is not None else None)
+        except StopIteration as stop:
+            self.done, self.result = True, stop.value
+            return
+        except BaseException:
+            self.done = True
+            raise
+
+        if isinstance(yielded, Future):
+            self._waiting = yielded
+
+    def cancel(self):
+        self._generator.close()
+        self.done = True
+
 
+class Scheduler:
+    # Deferred work. Jobs (CPU or IO bound) run on a long-lived pool of workers, continuations of jobs and cooperative
+    # tasks run on the main thread within update(), which is called once per frame (see Main) and stops when the budget
+    # is spent. A task is a generator: every yield ends a slice of the task, a yielded future suspends the task until
+    # the future is done. At least one slice runs per update() regardless of the budget, so tasks always progress.
+    # Bulk jobs (e.g. decoding of media) run on workers of their own, so interactive jobs never queue behind them
 
-def post_event(event_or_code, **params):
-    e = pygame.event.Event(event_or_code, **params) if isinstance(event_or_code, int) else event_or_code
-    pygame.event.post(e)
+    def __init__(self, workers=4):
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='worker')
+        self._background = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='background')
+        self._continuations = deque()  # appended by workers too
+        self._tasks = deque()
+
+    def submit(self, fn, *args, then=None, background=False, **kwargs):
+        """
+        runs the job on a worker
+
+        :param then: Function called on the main thread (within update()) with the future of the job once it is done
+        :param background: Whether the job is a bulk one, which may wait for workers
+        :returns: :class:`concurrent.futures.Future`
+        """
+
+        future = (self._background if background else self._executor).submit(fn, *args, **kwargs)
+        if then is not None:
+            future.add_done_callback(lambda done: self._continuations.append(lambda: then(done)))
+        return future
+
+    def call_soon(self, fn, *args):
+        # calls the function on the main thread within the next update()
+        self._continuations.append(lambda: fn(*args))
+
+    def spawn(self, generator):
+        """
+        :returns: :class:`Task` - the task of the generator, its first slice runs within the next update()
+        """
+
+        task = Task(generator)
+        self._tasks.append(task)
+        return task
+
+    def update(self, budget=FRAME_TASKS_BUDGET):
+        deadline = time.perf_counter() + budget
+        ran = False
+
+        while self._continuations and (not ran or time.perf_counter() < deadline):
+            self._continuations.popleft()()
+            ran = True
+
+        waiting = 0  # tasks skipped in a row, since they are suspended
+        while self._tasks and waiting < len(self._tasks) and (not ran or time.perf_counter() < deadline):
+            task = self._tasks.popleft()
+            if task.ready:
+                task.step()
+                ran, waiting = True, 0
+            else:
+                waiting += 1
+            if not task.done:
+                self._tasks.append(task)
+
+
+scheduler = Scheduler()
+
+
+def get_media_manifest():
+    """
+    lists media files used by the game regardless of the pack: buttons, texts, decorations and previews of packs (see
+    get_pack_manifest() for the rest of the files of the packs)
+
+    :returns: :class:`list[tuple[str, bool]]` - (filename, keep_alpha) pairs, see load_media()
+    """
+
+    manifest = []
+
+    for name, value in vars(Media).items():
+        if not name.isupper() or not isinstance(value, str) or value in Media.PACKS or '{}' in value:
+            continue
+        if _exists(value):
+            manifest.append((value, True))
+
+    # editor shows every pack as its block
+    manifest.extend((Media.BLOCK.format(pack), True) for pack in Media.PACKS)
+
+    return manifest
+
+
+def get_startup_manifest():
+    """
+    lists media files shown by the menu (see Media.STARTUP)
+
+    :returns: :class:`list[tuple[str, bool]]` - (filename, keep_alpha) pairs, see load_media()
+    """
+
+    return [(filename, True) for filename in Media.STARTUP]
+
+
+def get_pack_manifest(pack):
+    """
+    lists media files of the pack
+
+    :returns: :class:`list[tuple[str, bool]]` - (filename, keep_alpha) pairs, see load_media()
+    """
+
+    manifest = []
+
+    for name, value in vars(Media).items():
+        if name.isupper() and isinstance(value, str) and '{}' in value and _exists(value.format(pack)):
+            manifest.append((value.format(pack), True))
+
+    # editor draws backgrounds without alpha channel
+    manifest.append((Media.BACKGROUND.format(pack), False))
+
+    return manifest
+
+
+class MediaPreloader:
+    # Decodes media files on workers of the scheduler, so load_media() does not touch the disk afterwards. Decoded
+    # images must be converted to the display format on the main thread, either by convert() every frame or by run()
+    # as a task of the scheduler
+
+    def __init__(self, manifest):
+        self._decoding = deque()
+
+        for filename, keep_alpha in manifest:
+            for rel in _get_frames(filename) or (filename,):
+                if (rel, keep_alpha) not in media_cache:
+                    self._decoding.append((rel, keep_alpha, scheduler.submit(_decode, rel, background=True)))
+        self._total = len(self._decoding)
+
+    @property
+    def progress(self):
+        return 1 - len(self._decoding) / self._total if self._total else 1
+
+    @property
+    def done(self):
+        return not self._decoding
+
+    def _convert_next(self):
+        rel, keep_alpha, future = self._decoding.popleft()
+        try:
+            loaded = future.result()
+        except (pygame.error, OSError):  # will be raised by load_media() on usage
+            return
+        media_cache.put((rel, keep_alpha), _convert(loaded, keep_alpha))
+
+    def convert(self, budget=0.008):
+        # converts decoded images (in order) until budget (seconds) is spent or the next image is not decoded yet
+        deadline = time.perf_counter() + budget
+
+        while self._decoding and self._decoding[0][2].done() and time.perf_counter() < deadline:
+            self._convert_next()
+
+    def run(self):
+        # task of the scheduler (see Scheduler.spawn()): converts one image per slice, waits for decoding meanwhile
+        while self._decoding:
+            if not self._decoding[0][2].done():
+                try:
+                    yield self._decoding[0][2]
+                except (pygame.error, OSError):  # skipped by _convert_next()
+                    pass
+            self._convert_next()
+            yield
+
+    def wait(self):
+        # blocks until everything is decoded and converted
+        wait([future for *_, future in self._decoding])
+        self.convert(budget=float('inf'))
+
+
+def _get_pack(key):
+    # pack of the cached media (keys of media_cache start with the relative path), None if media is not pack-scoped
+    pack = os.path.normpath(key[0]).split(os.sep, 1)[0]
+    return pack if pack in Media.PACKS else None
+
+
+class MediaPacks:
+    # Pack-scoped media (see get_pack_manifest()). A pack is loaded by a task of the scheduler on request and is
+    # unloaded from the media cache when it has not been used for idle_timeout seconds, or sooner when the cache is
+    # under pressure. Windows using a pack must touch() it every frame, update() must be called every frame by the main
+    # loop
+
+    def __init__(self, idle_timeout):
+        self._idle_timeout = idle_timeout
+
+        self._loading = {}  # pack: (MediaPreloader, Task)
+        self._loaded = set()
+        self._last_used = {}
+
+    def touch(self, pack):
+        self._last_used[pack] = time.monotonic()
+
+    def is_loaded(self, pack):
+        return pack in self._loaded
+
+    def load(self, pack, block=False):
+        """
+        requests the pack (and touches it)
+
+        :param block: If True, waits until the pack is loaded. Otherwise, the pack is loaded within the next frames
+        :returns: :class:`bool` - whether the pack is loaded
+        """
+
+        self.touch(pack)
+        if pack in self._loaded:
+            return True
+
+        if pack not in self._loading:
+            preloader = MediaPreloader(get_pack_manifest(pack))
+            self._loading[pack] = (preloader, scheduler.spawn(self._load(pack, preloader)))
+        if block:
+            preloader, task = self._loading.pop(pack)
+            task.cancel()
+            preloader.wait()
+            self._loaded.add(pack)
+
+        return pack in self._loaded
+
+    def _load(self, pack, preloader):
+        yield from preloader.run()
+        del self._loading[pack]
+        self._loaded.add(pack)
+
+    def unload(self, pack):
+        self._loaded.discard(pack)
+        media_cache.discard(lambda key: _get_pack(key) == pack)
+
+    def update(self):
+        # under pressure, packs which have not been touched within the last second are unloaded
+        pressure = media_cache.resident_bytes > media_cache.budget * MEDIA_CACHE_PRESSURE
+        idle_timeout = 1 if pressure else self._idle_timeout
+        now = time.monotonic()
+        for pack in tuple(self._loaded):
+            if now - self._last_used.get(pack, 0) > idle_timeout:
+                self.unload(pack)
+
+
+media_packs = MediaPacks(PACK_IDLE_TIMEOUT)
 
 
 def get_tiles(*names):
@@ -81,38 +513,384 @@ def get_tiles(*names):
     return result
 
 
-def _memoize(fn):
-    _memoized = []
+class EventDispatcher:
+    # Events of the frame indexed by type. Long-living handlers (e.g. Main) subscribe to the types they handle. Surfaces
+    # listen to the types they are interested in: they are referenced weakly (surfaces created on the fly stop listening
+    # once dropped) and receive events only if they have been handled in the previous frame (see BaseSurface.handle()),
+    # so the ones which are not shown do not react. Both are called by dispatch(), nobody iterates over events of
+    # foreign types and nobody polls the queue every frame
+
+    # events which are delivered only if they hit the absolute rect of the listening surface. Releases are delivered
+    # anyway, since mouse button may be released outside the surface it was pressed on
+    HIT_TESTED = (pygame.MOUSEBUTTONDOWN, pygame.MOUSEMOTION)
+
+    def __init__(self):
+        self.frame = 0  # number of the current frame, surfaces store the one they have been handled in
+        self._events = []
+        self._by_type = {}  # type: indices of events in self._events
+        self._subscribers = {}  # type: callbacks
+        self._listeners = {}  # type: {surface: functions} (weak keys)
+
+    def update(self):
+        # takes a new queue of events, which is available until the next update
+        self.frame += 1
+        self._events = pygame.event.get()
+        self._by_type = {}
+        for idx, event in enumerate(self._events):
+            self._by_type.setdefault(event.type, []).append(idx)
+
+    def subscribe(self, event_type, callback):
+        self._subscribers.setdefault(event_type, []).append(callback)
+
+    def unsubscribe(self, event_type, callback):
+        self._subscribers.get(event_type, []).remove(callback)
+
+    def listen(self, event_type, method, hit_tested=True, handled_only=True):
+        """
+        :param method: Bound method of a surface, the surface is referenced weakly (the method is called via its class)
+        :param hit_tested: Whether events of HIT_TESTED types are delivered only if they hit the surface
+        :param handled_only: Whether events are delivered only if the surface has been handled in the previous frame
+        """
+
+        functions = self._listeners.setdefault(event_type, weakref.WeakKeyDictionary()).setdefault(method.__self__, [])
+        functions.append((method.__func__, hit_tested and event_type in self.HIT_TESTED, handled_only))
+
+    def dispatch(self):
+        # calls subscribers and listeners of the events (in order of the events). Listeners added meanwhile receive
+        # events since the next frame
+        for idx in heapq.merge(*(self._by_type.get(event_type, ()) for event_type in self._subscribers)):
+            event = self._events[idx]
+            for callback in self._subscribers[event.type]:
+                callback(event)
+
+        for idx in heapq.merge(*(self._by_type.get(event_type, ()) for event_type in self._listeners)):
+            event = self._events[idx]
+            for surface, functions in tuple(self._listeners[event.type].items()):
+                handled = surface.handled_frame == self.frame - 1
+                for function, hit_tested, handled_only in functions:
+                    if handled_only and not handled:
+                        continue
+                    if not hit_tested or surface.get_absolute_rect().collidepoint(event.pos):
+                        function(surface, event)
+
+    def get(self, *types, rect=None):
+        """
+        gets events of the current frame
 
-    @wraps(fn)
-    def __wrapper__(update=True, /):
-        nonlocal _memoized
+        :param types: Types of events to be returned (in order of the events)
+        :param rect: Absolute rect, if provided, events of HIT_TESTED types are returned only if their position hits it
+        :returns: :class:`list[pygame.event.Event]`
+        """
 
-        if update:
-            _memoized = fn(update)  # immutable expected
-        return _memoized
+        events = [self._events[idx] for idx in heapq.merge(*(self._by_type.get(t, ()) for t in types))]
+        if rect is None:
+            return events
+        return [event for event in events if event.type not in self.HIT_TESTED or rect.collidepoint(event.pos)]
 
-    return __wrapper__
 
+dispatcher = EventDispatcher()
 
-@_memoize
-def catch_events(_update_=True, /):
-    return pygame.event.get()
 
+class MessageBus:
+    # Messages between components of the game (topics are listed in constants.Messages). Subscribers are called
+    # directly with the arguments of the message, no event objects are created. publish() delivers a message at once,
+    # post() delays it until deliver() is called by the main loop at the end of the frame (e.g. the windows stack must
+    # not be changed while windows are handled). Subscribers must live as long as the bus, surfaces which are created
+    # and dropped on the fly should compare get_count() between frames instead. Posted messages carry one argument at
+    # most and are stored in preallocated slots of a ring, so posting does not allocate
 
+    SLOTS = 32  # initial capacity of the ring, it is doubled if a frame posts more messages
+
+    def __init__(self):
+        self._subscribers = {}  # topic: callbacks
+        self._counts = {}  # topic: number of delivered messages
+        self._topics = [None] * self.SLOTS  # slot: topic of the posted message
+        self._args = [None] * self.SLOTS  # slot: argument of the posted message (Ellipsis if there is no argument)
+        self._head = 0  # slot of the next message to be delivered
+        self._posted = 0  # number of posted messages which are not delivered yet
+
+    def subscribe(self, topic, callback):
+        self._subscribers.setdefault(topic, []).append(callback)
+
+    def unsubscribe(self, topic, callback):
+        self._subscribers.get(topic, []).remove(callback)
+
+    def publish(self, topic, *args):
+        self._counts[topic] = self._counts.get(topic, 0) + 1
+        for callback in self._subscribers.get(topic, ()):
+            callback(*args)
+
+    def post(self, topic, arg=...):
+        if self._posted == len(self._topics):
+            self._grow()
+        slot = (self._head + self._posted) % len(self._topics)
+        self._topics[slot] = topic
+        self._args[slot] = arg
+        self._posted += 1
+
+    def _grow(self):
+        # unrolls the ring, so the next message to be delivered is in the first slot
+        size = len(self._topics)
+        self._topics = self._topics[self._head:] + self._topics[:self._head] + [None] * size
+        self._args = self._args[self._head:] + self._args[:self._head] + [None] * size
+        self._head = 0
+
+    def deliver(self):
+        # delivers posted messages in order, including the ones posted by subscribers meanwhile
+        while self._posted:
+            topic, arg = self._topics[self._head], self._args[self._head]
+            self._args[self._head] = None  # the argument is not kept alive by the slot
+            self._head = (self._head + 1) % len(self._topics)
+            self._posted -= 1
+
+            self._counts[topic] = self._counts.get(topic, 0) + 1
+            for callback in self._subscribers.get(topic, ()):
+                if arg is ...:
+                    callback()
+                else:
+                    callback(arg)
+
+    def get_count(self, topic):
+        return self._counts.get(topic, 0)
+
+
+bus = MessageBus()
+
+
+class _WriteBehindQueue:
+    # Background writer used by DataBase. Writes are stored by key, so a write replacing a pending one with the same key
+    # is coalesced instead of being queued again (e.g. only the best completion per level and user reaches the disk).
+    # Every batch taken by the writer thread is committed once, every write of the batch is made within its own
+    # savepoint, so a failed write leaves nothing behind. Callbacks of failed writes are collected and have to be
+    # invoked from the main thread with dispatch_errors()
+
+    def __init__(self, maxsize=64):
+        self._maxsize = maxsize
+        self._pending = {}  # key: (method, args, on_error); dictionaries keep insertion order, so do writes
+        self._in_progress = {}  # batch being written, but not committed yet
+        self._failed = Queue()
+        self._condition = threading.Condition()
+        self._closed = False
+
+        self._thread = threading.Thread(target=self._run, name='DataBaseWriter', daemon=True)
+        self._thread.start()
+
+    def put(self, key, method, args, on_error=None, merge=None):
+        with self._condition:
+            if self._closed:
+                raise RuntimeError('Writer has been closed, no more writes are accepted')
+
+            # bounded: blocks the caller until the writer catches up (coalesced writes never block)
+            while key not in self._pending and len(self._pending) >= self._maxsize:
+                self._condition.wait()
+
+            if key in self._pending and merge is not None:
+                args = merge(self._pending[key][1], args)
+            self._pending[key] = (method, args, on_error)
+            self._condition.notify_all()
+
+    def pending(self, method):
+        # args of writes made by the method, which may be not visible to readers yet
+        with self._condition:
+            return [a for m, a, _ in (*self._in_progress.values(), *self._pending.values()) if m == method]
+
+    def read(self, query, *methods):
+        """
+        runs query({method: [args of its pending writes], ...}). The batch being written is not committed meanwhile, so
+        rows read by the query and pending writes neither overlap nor miss each other
+
+        :returns: result of the query
+        """
+
+        with self._condition:
+            pending = (*self._in_progress.values(), *self._pending.values())
+            return query({method: [a for m, a, _ in pending if m == method] for method in methods})
+
+    def has_pending(self, table):
+        with self._condition:
+            return any(key[0] == table for key in (*self._in_progress, *self._pending))
+
+    def join(self):
+        with self._condition:
+            while self._pending or self._in_progress:
+                self._condition.wait()
+
+    def close(self):
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+        self._thread.join()
+
+    def dispatch_errors(self):
+        while True:
+            try:
+                on_error, error = self._failed.get_nowait()
+            except Empty:
+                return
+            if on_error is None:
+                traceback.print_exception(type(error), error, error.__traceback__, file=sys.stderr)
+            else:
+                on_error(error)
+
+    def _run(self):
+        db = DataBase()
+
+        while True:
+            with self._condition:
+                while not self._pending and not self._closed:
+                    self._condition.wait()
+                if not self._pending:  # closed and flushed
+                    return
+                self._in_progress, self._pending = self._pending, {}
+                self._condition.notify_all()
+
+            written = []
+            db._begin()
+            for method, args, on_error in self._in_progress.values():
+                db._cursor.execute('SAVEPOINT write')
+                try:
+                    getattr(db, method)(*args)
+                    written.append(on_error)
+                except Exception as e:
+                    db._cursor.execute('ROLLBACK TO write')  # e.g. a level is not saved without its tiles
+                    self._failed.put((on_error, e))
+                db._cursor.execute('RELEASE write')
+
+            # readers see either the pending batch or the committed one (see read())
+            with self._condition:
+                try:
+                    db._commit()
+                except Exception as e:
+                    db._rollback()
+                    for on_error in written:
+                        self._failed.put((on_error, e))
+                self._in_progress = {}
+                DataBase._user_levels_num = None
+                self._condition.notify_all()
+
+
+class _InstrumentedCursor:
+    # Cursor of DataBase reporting every query to diagnostics.query_stats. Rows and time of fetching are added to the
+    # last executed query. A script (or a query executed with many parameters) is reported as one query
+
+    def __init__(self, cursor):
+        self._cursor = cursor
+        self._fingerprint = None
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+    def _run(self, method, sql, *args):
+        query_stats.check(sql)
+        start = time.perf_counter()
+        method(sql, *args)
+        self._fingerprint = query_stats.record(sql, time.perf_counter() - start, max(self._cursor.rowcount, 0))
+        return self
+
+    def execute(self, sql, parameters=()):
+        return self._run(self._cursor.execute, sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self._run(self._cursor.executemany, sql, seq_of_parameters)
+
+    def executescript(self, sql_script):
+        return self._run(self._cursor.executescript, sql_script)
+
+    def fetchone(self):
+        start = time.perf_counter()
+        row = self._cursor.fetchone()
+        query_stats.add_fetched(self._fingerprint, time.perf_counter() - start, row is not None)
+        return row
+
+    def fetchall(self):
+        start = time.perf_counter()
+        rows = self._cursor.fetchall()
+        query_stats.add_fetched(self._fingerprint, time.perf_counter() - start, len(rows))
+        return rows
+
+
+@timed_methods('database')
 class DataBase:
     USERS_TABLE = 'users'
     LEVELS_TABLE = 'levels'
     TILES_TABLE = 'tiles'
     COMPLETED_LEVELS_TABLE = 'completedLevels'
+    LEVELS_SEARCH_TABLE = 'levelsSearch'  # FTS5 index over names and authors of user levels, see search_levels()
+    LEVELS_HASHES_TABLE = 'levelsHashes'  # content hashes of levels, see precompute.LevelArtefacts
+
+    # writes (create_level, delete_level, save_completion, save_content_hash) are made asynchronously by the
+    # write-behind queue, so they never block a frame. Readers take pending writes into account. Call DataBase.flush()
+    # before exit
+    _writer = None
+    _user_levels_num = None  # cached, reset by commits of the writer
+    _last_level_id = None  # reserved by create_level()
+    _ids_lock = threading.Lock()
+    _search_index_ready = False
+    _leaderboard_index_ready = False
+    _hashes_table_ready = False
 
     def __init__(self):
         with sqlite3.connect(DB_URL) as connection:
-            self._cursor = connection.cursor()
+            self._cursor = _InstrumentedCursor(connection.cursor())
+
+    def _begin(self):
+        self._cursor.execute('BEGIN')
 
     def _commit(self):
         self._cursor.connection.commit()
 
+    def _rollback(self):
+        self._cursor.connection.rollback()
+
+    @classmethod
+    def _get_writer(cls):
+        if cls._writer is None:
+            cls._writer = _WriteBehindQueue()
+        return cls._writer
+
+    @classmethod
+    def flush(cls):
+        # writes everything pending and stops the writer thread (a new one will be started on the next write)
+        if cls._writer is None:
+            return
+        cls._writer.close()
+        cls._writer.dispatch_errors()
+        cls._writer = None
+
+    @classmethod
+    def dispatch_write_errors(cls):
+        # must be called from the main thread. Invokes on_error callbacks of failed writes
+        if cls._writer is not None:
+            cls._writer.dispatch_errors()
+
+    def _get_pending(self, method):
+        return self._writer.pending(method) if self._writer is not None else []
+
+    def _sync(self, table):
+        # ranks are counted by the database, so readers of the table wait for its pending writes (on workers only)
+        if self._writer is not None and self._writer.has_pending(table):
+            self._writer.join()
+
+    def _read_levels(self, query):
+        # levels are read with pending writes merged (see _WriteBehindQueue.read()), query gets levels created by them
+        # {id: (name, fdata, author id, pack)} and ids of saved levels deleted by them
+        def _query(pending):
+            created = {level_id: args for level_id, *args in pending['_create_level']}
+            deleted = {level_id for level_id, in pending['_delete_level']}
+            return query({level_id: args for level_id, args in created.items() if level_id not in deleted},
+                         deleted - created.keys())
+
+        if self._writer is None:
+            return _query({'_create_level': [], '_delete_level': []})
+        return self._writer.read(_query, '_create_level', '_delete_level')
+
+    def _get_login(self, uid):
+        return self._cursor.execute(f'SELECT login FROM {self.USERS_TABLE} WHERE uid = ?', (uid,)).fetchone()[0]
+
+    @staticmethod
+    def _get_placeholders(values):
+        return ', '.join('?' * len(values))
+
     def get_user(self, uid):
         return self._cursor.execute(f'''SELECT * FROM {self.USERS_TABLE} WHERE uid = ?''', (uid,)).fetchone()
 
@@ -120,7 +898,9 @@ class DataBase:
         if self.get_uid(login):
             raise OverflowError(f'Login "{login}" is already taken')
 
-        password = bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt())
+        import bcrypt  # not needed until a form is submitted, so it is imported on the first use (by the auth worker)
+
+        password = bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt(rounds=BCRYPT_ROUNDS))
 
         self._cursor.execute(
             f'INSERT INTO {self.USERS_TABLE} (login, password) VALUES (?, ?)',
@@ -133,40 +913,130 @@ class DataBase:
         return fetched[0] if fetched else None
 
     def is_correct_password(self, uid, password):
+        import bcrypt
+
         saved_hashed = self.get_user(uid)[2]
         return bcrypt.checkpw(password.encode('utf-8'), saved_hashed)
 
     def get_level_by_name(self, name, uid):
-        return self._cursor.execute(
-            f'SELECT * FROM {self.LEVELS_TABLE} WHERE name = ? AND author_id = ?', (name, uid)
-        ).fetchone()
+        def query(created, deleted):
+            for level_id, (level_name, _, author_id, pack) in created.items():
+                if level_name == name and author_id == uid:
+                    return level_id, level_name, author_id, pack
+            return self._cursor.execute(
+                f'SELECT * FROM {self.LEVELS_TABLE} WHERE name = ? AND author_id = ? '
+                f'AND id NOT IN ({self._get_placeholders(deleted)})', (name, uid, *deleted)
+            ).fetchone()
+
+        return self._read_levels(query)
 
     def get_level_by_id(self, level_id):
-        return self._cursor.execute(f'SELECT * FROM {self.LEVELS_TABLE} WHERE id = ?', (level_id,)).fetchone()
+        def query(created, deleted):
+            if level_id in created:
+                name, _, author_id, pack = created[level_id]
+                return level_id, name, author_id, pack
+            if level_id not in deleted:
+                return self._cursor.execute(f'SELECT * FROM {self.LEVELS_TABLE} WHERE id = ?', (level_id,)).fetchone()
+
+        return self._read_levels(query)
 
     def get_level_field_data(self, level_id):
-        return self._cursor.execute(f'SELECT rowcol, tilename, angle FROM {self.TILES_TABLE}'
-                                    f' WHERE level_id = {level_id}').fetchall()
+        def query(created, _deleted):
+            if level_id in created:
+                return list(created[level_id][1])
+            return self._cursor.execute(f'SELECT rowcol, tilename, angle FROM {self.TILES_TABLE}'
+                                        f' WHERE level_id = ?', (level_id,)).fetchall()
+
+        return self._read_levels(query)
+
+    def _reserve_level_id(self):
+        # ids of levels are known before they are written, so readers merge pending levels (see _read_levels())
+        with DataBase._ids_lock:
+            if DataBase._last_level_id is None:
+                seq = self._cursor.execute('SELECT seq FROM sqlite_sequence WHERE name = ?',
+                                           (self.LEVELS_TABLE,)).fetchone()
+                last = self._cursor.execute(f'SELECT max(id) FROM {self.LEVELS_TABLE}').fetchone()[0]
+                DataBase._last_level_id = max(seq[0] if seq else 0, last or 0)
+            DataBase._last_level_id += 1
+            return DataBase._last_level_id
+
+    def create_level(self, name, fdata, uid, pack, on_error=None):
+        """
+        :returns: :class:`int` - id of the level, it is readable at once, though the level is written in the background
+        """
 
-    def create_level(self, name, fdata, uid, pack):
-        self._cursor.execute(f'INSERT INTO {self.LEVELS_TABLE} (name, author_id, pack)'
-                             f'VALUES (?, ?, ?)', (name, uid, pack))
-        self._save_data(fdata, self.get_level_by_name(name, uid)[0])
+        # every level is a new row, nothing to coalesce
+        level_id = self._reserve_level_id()
+        self._get_writer().put((self.LEVELS_TABLE, level_id), '_create_level',
+                               (level_id, name, tuple(fdata), uid, pack), on_error)
+        return level_id
+
+    def _create_level(self, level_id, name, fdata, uid, pack):
+        self._cursor.execute(f'INSERT INTO {self.LEVELS_TABLE} (id, name, author_id, pack)'
+                             f'VALUES (?, ?, ?, ?)', (level_id, name, uid, pack))
+        self._save_data(fdata, level_id)
 
     def _save_data(self, fdata, level_id):
         s = ', '.join((str((f'{rc}', f'{tn}', an, level_id)) for rc, tn, an in fdata))
         self._cursor.execute(f'INSERT INTO {self.TILES_TABLE} (rowcol, tilename, angle, level_id) VALUES {s};')
-        self._commit()
 
-    def delete_level(self, level_id):
+    def delete_level(self, level_id, on_error=None):
+        self._get_writer().put((self.LEVELS_TABLE, 'delete', level_id), '_delete_level', (level_id,), on_error)
+
+    def _delete_level(self, level_id):
         self._cursor.execute(f'DELETE FROM {self.LEVELS_TABLE} WHERE id = ?', (level_id,))
-        self._commit()
+
+    def _ensure_hashes_table(self):
+        # created on the first use, levels saved before get their hashes when they are opened (or precomputed)
+        if DataBase._hashes_table_ready:
+            return
+
+        self._cursor.execute(f'CREATE TABLE IF NOT EXISTS {self.LEVELS_HASHES_TABLE} '
+                             f'(level_id INTEGER NOT NULL PRIMARY KEY, hash TEXT NOT NULL)')
+        # the writer creates it within a batch, which may be rolled back
+        DataBase._hashes_table_ready = not self._cursor.connection.in_transaction
+
+    def get_content_hash(self, level_id):
+        """
+        :returns: :class:`str` - content hash of the level, None if it has not been stored yet
+        """
+
+        def query(pending):
+            if (saved := dict(pending['_save_content_hash'])).get(level_id) is not None:
+                return saved[level_id]
+            fetched = self._cursor.execute(f'SELECT hash FROM {self.LEVELS_HASHES_TABLE} WHERE level_id = ?',
+                                           (level_id,)).fetchone()
+            return fetched[0] if fetched else None
+
+        self._ensure_hashes_table()
+        if self._writer is None:
+            return query({'_save_content_hash': []})
+        return self._writer.read(query, '_save_content_hash')
+
+    def save_content_hash(self, level_id, content_hash, on_error=None):
+        self._get_writer().put((self.LEVELS_HASHES_TABLE, level_id), '_save_content_hash', (level_id, content_hash),
+                               on_error)
+
+    def _save_content_hash(self, level_id, content_hash):
+        self._ensure_hashes_table()
+        self._cursor.execute(f'INSERT OR REPLACE INTO {self.LEVELS_HASHES_TABLE} (level_id, hash) VALUES (?, ?)',
+                             (level_id, content_hash))
+
+    def _get_pending_completions(self, uid, system_only=False):
+        level_ids = set(lid for lid, u, _ in self._get_pending('_save_completion') if u == uid)
+        if not level_ids or not system_only:
+            return level_ids
+
+        return set(e[0] for e in self._cursor.execute(
+            f'SELECT id FROM {self.LEVELS_TABLE} WHERE author_id = 0 AND id IN ({", ".join("?" * len(level_ids))})',
+            tuple(level_ids)
+        ).fetchall())
 
     def get_unlocked_levels_num(self, uid):
-        return len(self._cursor.execute(
+        return len(set(e[0] for e in self._cursor.execute(
             f'SELECT DISTINCT id FROM {self.COMPLETED_LEVELS_TABLE} c '
             f'INNER JOIN {self.LEVELS_TABLE} l ON c.level_id = l.id WHERE uid = ? AND l.author_id = 0', (uid,)
-        ).fetchall()) + 1
+        ).fetchall()) | self._get_pending_completions(uid, system_only=True)) + 1
 
     def get_new_tiles(self, uid, level_id):
         unlocked = self.get_unlocked_tiles(uid)
@@ -179,36 +1049,207 @@ class DataBase:
 
         return get_tiles(*unique) if unique else dict()
 
-    def save_completion(self, level_id, uid, time):
+    def save_completion(self, level_id, uid, time, on_error=None):
         # no need to store all completions into the self.COMPLETED_LEVELS_TABLE table,
-        # we can actually just put the best (by time) completion
+        # we can actually just put the best (by time) completion, so pending completions are coalesced too
 
+        self._get_writer().put((self.COMPLETED_LEVELS_TABLE, level_id, uid), '_save_completion', (level_id, uid, time),
+                               on_error, merge=lambda old, new: old if old[2] <= new[2] else new)
+
+    def _save_completion(self, level_id, uid, time):
         self._cursor.execute(f'DELETE FROM {self.COMPLETED_LEVELS_TABLE} WHERE level_id = ? and uid = ?',
                              (level_id, uid))
         self._cursor.execute(f'INSERT INTO {self.COMPLETED_LEVELS_TABLE} (level_id, uid, time) VALUES (?, ?, ?)',
                              (level_id, uid, time))
-        self._commit()
 
     def get_best_time(self, level_id, uid):
         f = self._cursor.execute(
             f'SELECT MIN(time) FROM {self.COMPLETED_LEVELS_TABLE} WHERE level_id = ? AND uid = ?', (level_id, uid)
         ).fetchone()
-        return f if f is None else f[0]
+        times = [t for lid, u, t in self._get_pending('_save_completion') if lid == level_id and u == uid]
+        if f is not None and f[0] is not None:
+            times.append(f[0])
+        return min(times) if times else None
 
-    def get_pages_num(self, items_on_page):
-        f = self._cursor.execute(f'SELECT count() FROM {self.LEVELS_TABLE} WHERE author_id != 0').fetchone()[0]
-        return f // items_on_page + (1 if f % items_on_page != 0 else 0)
+    def _get_user_levels_num(self):
+        def query(created, deleted):
+            if DataBase._user_levels_num is None:
+                DataBase._user_levels_num = self._cursor.execute(
+                    f'SELECT count() FROM {self.LEVELS_TABLE} WHERE author_id != 0'
+                ).fetchone()[0]
+            # system levels are never deleted
+            return DataBase._user_levels_num + sum(args[2] != 0 for args in created.values()) - len(deleted)
+
+        return self._read_levels(query)
+
+    def _ensure_leaderboard_index(self):
+        # COMPLETED_LEVELS_TABLE keeps only the best time per level and user, so with this index it is a ranking table:
+        # top of a level is a range scan and rank of a user is a range count, both without sorting the completions
+        if DataBase._leaderboard_index_ready:
+            return
+
+        self._cursor.execute(f'CREATE INDEX IF NOT EXISTS {self.COMPLETED_LEVELS_TABLE}Ranking '
+                             f'ON {self.COMPLETED_LEVELS_TABLE} (level_id, time)')
+        self._commit()
+        DataBase._leaderboard_index_ready = True
+
+    def get_leaderboard(self, level_id, limit):
+        self._sync(self.COMPLETED_LEVELS_TABLE)
+        self._ensure_leaderboard_index()
 
-    def load_page(self, page, items_on_page):
         return self._cursor.execute(
-            f'SELECT l.id, l.name, l.author_id, u.login FROM {self.LEVELS_TABLE} l '
-            f'INNER JOIN {self.USERS_TABLE} u ON l.author_id = u.uid '
-            f'WHERE l.author_id != 0 '
-            f'ORDER BY l.id DESC '
-            f'LIMIT ? OFFSET ?',
-            (items_on_page, (page - 1) * items_on_page)
+            f'SELECT u.login, c.time FROM {self.COMPLETED_LEVELS_TABLE} c '
+            f'INNER JOIN {self.USERS_TABLE} u ON c.uid = u.uid '
+            f'WHERE c.level_id = ? ORDER BY c.time LIMIT ?',
+            (level_id, limit)
         ).fetchall()
 
+    def get_rank(self, level_id, uid):
+        """
+        gets place of the user in the leaderboard of the level
+
+        :returns: :class:`tuple[int | None, int]` - rank (None, if the user has not completed the level), total number
+            of users completed the level
+        """
+
+        self._sync(self.COMPLETED_LEVELS_TABLE)
+        self._ensure_leaderboard_index()
+
+        total = self._cursor.execute(
+            f'SELECT count() FROM {self.COMPLETED_LEVELS_TABLE} WHERE level_id = ?', (level_id,)
+        ).fetchone()[0]
+        best_time = self.get_best_time(level_id, uid)
+        if best_time is None:
+            return None, total
+
+        return self._cursor.execute(
+            f'SELECT count() FROM {self.COMPLETED_LEVELS_TABLE} WHERE level_id = ? AND time < ?', (level_id, best_time)
+        ).fetchone()[0] + 1, total
+
+    def get_pages_num(self, items_on_page):
+        f = self._get_user_levels_num()
+        return f // items_on_page + (1 if f % items_on_page != 0 else 0)
+
+    def load_page(self, items_on_page, after=None, before=None):
+        # keyset pagination: levels are listed from the newest one (by id), so the next page starts after the last id
+        # of the current page and the previous one ends before its first id. Returns the first page if none provided
+        def query(created, deleted):
+            sql = (f'SELECT l.id, l.name, l.author_id, u.login FROM {self.LEVELS_TABLE} l '
+                   f'INNER JOIN {self.USERS_TABLE} u ON l.author_id = u.uid '
+                   f'WHERE l.author_id != 0 AND l.id NOT IN ({self._get_placeholders(deleted)}) ')
+            rows = [(level_id, name, author_id, self._get_login(author_id))
+                    for level_id, (name, _, author_id, _) in created.items() if author_id != 0 and
+                    (before is None or level_id > before) and (after is None or level_id < after)]
+            if before is not None:
+                rows += self._cursor.execute(sql + 'AND l.id > ? ORDER BY l.id ASC LIMIT ?',
+                                             (*deleted, before, items_on_page)).fetchall()
+                return sorted(rows)[:items_on_page][::-1]
+            if after is not None:
+                rows += self._cursor.execute(sql + 'AND l.id < ? ORDER BY l.id DESC LIMIT ?',
+                                             (*deleted, after, items_on_page)).fetchall()
+            else:
+                rows += self._cursor.execute(sql + 'ORDER BY l.id DESC LIMIT ?', (*deleted, items_on_page)).fetchall()
+            return sorted(rows, reverse=True)[:items_on_page]
+
+        return self._read_levels(query)
+
+    def _ensure_search_index(self):
+        # created on the first search and filled with existing levels once, since then it is updated by triggers on
+        # every insertion/deletion of a level (create_level(), delete_level())
+        if DataBase._search_index_ready:
+            return
+
+        exists = self._cursor.execute(
+            'SELECT 1 FROM sqlite_master WHERE type = ? AND name = ?', ('table', self.LEVELS_SEARCH_TABLE)
+        ).fetchone()
+        if not exists:
+            self._cursor.executescript(f'''
+                CREATE VIRTUAL TABLE {self.LEVELS_SEARCH_TABLE} USING fts5(name, login, tokenize = "unicode61");
+
+                CREATE TRIGGER {self.LEVELS_SEARCH_TABLE}Insert AFTER INSERT ON {self.LEVELS_TABLE}
+                WHEN new.author_id != 0 BEGIN
+                    INSERT INTO {self.LEVELS_SEARCH_TABLE} (rowid, name, login)
+                    VALUES (new.id, new.name, (SELECT login FROM {self.USERS_TABLE} WHERE uid = new.author_id));
+                END;
+
+                CREATE TRIGGER {self.LEVELS_SEARCH_TABLE}Delete AFTER DELETE ON {self.LEVELS_TABLE} BEGIN
+                    DELETE FROM {self.LEVELS_SEARCH_TABLE} WHERE rowid = old.id;
+                END;
+
+                INSERT INTO {self.LEVELS_SEARCH_TABLE} (rowid, name, login)
+                SELECT l.id, l.name, u.login FROM {self.LEVELS_TABLE} l
+                INNER JOIN {self.USERS_TABLE} u ON l.author_id = u.uid WHERE l.author_id != 0;
+            ''')
+            self._commit()
+
+        DataBase._search_index_ready = True
+
+    @staticmethod
+    def _to_match_query(text):
+        # every word of the text is searched as a prefix, FTS5 syntax is escaped by quoting
+        return ' '.join('"{}"*'.format(word.replace('"', '""')) for word in text.split())
+
+    def _search_pending(self, text, created):
+        # pending levels are not indexed yet, they are matched as the index does it (every word of the text is a prefix
+        # of a word of the name or of the author) and go first, since they are the newest ones
+        words = re.findall(r'\w+', text.casefold())
+        found = []
+        for level_id, (name, _, author_id, _) in sorted(created.items(), reverse=True):
+            if author_id == 0:
+                continue
+            login = self._get_login(author_id)
+            indexed = re.findall(r'\w+', f'{name} {login}'.casefold())
+            if all(any(w.startswith(word) for w in indexed) for word in words):
+                found.append((level_id, name, author_id, login))
+        return found
+
+    def get_search_pages_num(self, text, items_on_page):
+        if not text.split():
+            return 0
+
+        self._ensure_search_index()
+
+        def query(created, deleted):
+            return self._cursor.execute(
+                f'SELECT count() FROM {self.LEVELS_SEARCH_TABLE} WHERE {self.LEVELS_SEARCH_TABLE} MATCH ? '
+                f'AND rowid NOT IN ({self._get_placeholders(deleted)})',
+                (self._to_match_query(text), *deleted)
+            ).fetchone()[0] + len(self._search_pending(text, created))
+
+        f = self._read_levels(query)
+        return f // items_on_page + (1 if f % items_on_page != 0 else 0)
+
+    def search_levels(self, text, items_on_page, page=1):
+        # same rows as load_page(), ordered by relevance (matches in names weigh more than matches in authors)
+        if not text.split():
+            return []
+
+        self._ensure_search_index()
+
+        def query(created, deleted):
+            found = self._search_pending(text, created)
+            rows = found[(page - 1) * items_on_page:page * items_on_page]
+            return rows + self._cursor.execute(
+                f'SELECT l.id, l.name, l.author_id, s.login FROM {self.LEVELS_SEARCH_TABLE} s '
+                f'INNER JOIN {self.LEVELS_TABLE} l ON l.id = s.rowid '
+                f'WHERE {self.LEVELS_SEARCH_TABLE} MATCH ? AND l.id NOT IN ({self._get_placeholders(deleted)}) '
+                f'ORDER BY bm25({self.LEVELS_SEARCH_TABLE}, 2.0, 1.0), l.id DESC '
+                f'LIMIT ? OFFSET ?',
+                (self._to_match_query(text), *deleted, items_on_page - len(rows),
+                 max((page - 1) * items_on_page - len(found), 0))
+            ).fetchall()
+
+        return self._read_levels(query)
+
+    def get_levels_packs(self):
+        def query(created, deleted):
+            return [(level_id, args[3]) for level_id, args in created.items()] + self._cursor.execute(
+                f'SELECT id, pack FROM {self.LEVELS_TABLE} WHERE id NOT IN ({self._get_placeholders(deleted)})',
+                tuple(deleted)
+            ).fetchall()
+
+        return self._read_levels(query)
+
     def get_system_levels(self):
         return self._cursor.execute(f'SELECT id, name FROM {self.LEVELS_TABLE} WHERE author_id = 0').fetchall()
 
@@ -221,4 +1262,11 @@ class DataBase:
             (uid,)
         ).fetchall()
 
+        if pending := self._get_pending_completions(uid, system_only=True):
+            tilenames += self._cursor.execute(
+                f'SELECT DISTINCT tilename FROM {self.TILES_TABLE} '
+                f'WHERE level_id IN ({", ".join("?" * len(pending))})',
+                tuple(pending)
+            ).fetchall()
+
         return get_tiles(*(t[0] for t in tilenames)) if tilenames else dict()
@@ -0,0 +1,49 @@
+import os
+import sys
+import tempfile
+import unittest
+
+os.environ.setdefault('SDL_VIDEODRIVER', 'dummy')
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'source'))
+
+import pygame  # noqa: E402
+
+from bundle import MediaBundle, build_bundle  # noqa: E402
+
+
+class MediaBundleTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        pygame.init()
+        pygame.display.set_mode((1, 1))
+
+    @classmethod
+    def tearDownClass(cls):
+        pygame.quit()
+
+    def test_loads_images_in_display_format(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            media_dir = os.path.join(tmp, 'media')
+            os.makedirs(os.path.join(media_dir, 'fly.gif'))
+            image = pygame.Surface((3, 2), pygame.SRCALPHA)
+            image.fill((10, 20, 30, 40))
+            image.set_at((2, 1), (200, 150, 100, 255))
+            pygame.image.save(image, os.path.join(media_dir, 'fly.gif', 'hero1.png'))
+
+            path = os.path.join(tmp, 'media.bundle')
+            self.assertEqual(build_bundle(media_dir, path), 1)
+
+            bundle = MediaBundle(path)
+            self.assertIn(os.path.join('fly.gif', 'hero1.png'), bundle)
+            loaded = bundle.load(os.path.join('fly.gif', 'hero1.png'))
+            self.assertEqual(loaded.get_size(), (3, 2))
+            self.assertEqual(tuple(loaded.get_at((0, 0))), (10, 20, 30, 40))
+            self.assertEqual(tuple(loaded.get_at((2, 1))), (200, 150, 100, 255))
+            # served without conversion, the surface shares memory with the mapping
+            self.assertTrue(MediaBundle.is_display_format(loaded))
+            del loaded, bundle
+
+
+if __name__ == '__main__':
+    unittest.main()